@@ -0,0 +1,192 @@
+"""
+Локальная проверка распределения городов между экземплярами бота.
+
+Запускает несколько рабочих процессов с общей базой SQLite (как при PARTITION_DB),
+проверяет, что каждый город обрабатывается ровно одним экземпляром, затем
+«роняет» один из них без освобождения аренды и проверяет, что его города
+перешли к остальным после истечения аренды.
+
+Затем запускает экземпляры бота с утренней рассылкой по городам, «роняет» один
+из них перед рассылкой и проверяет, что прогноз по каждому городу все равно
+дошел до подписчика ровно один раз.
+
+Пример:
+    python partition_check.py --workers 4 --cities 300
+"""
+import argparse
+import asyncio
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+from collections import Counter
+
+
+def worker(db_path, instance_id, cities, lease_ttl, reports):
+    from replay import load_bot_module
+
+    bot_module = load_bot_module()
+    partitioner = bot_module.CityPartitioner(db_path, instance_id, lease_ttl)
+    while True:
+        partitioner.heartbeat()
+        owned = partitioner.acquire(cities)
+        reports.put((instance_id, time.time(), sorted(owned)))
+        time.sleep(lease_ttl / 5)
+
+
+def digest_worker(db_path, instance_id, cities, lease_ttl, digest_at, reports):
+    # Разделитель бота создается при импорте, поэтому настройки задаются заранее
+    os.environ["PARTITION_DB"] = db_path
+    os.environ["INSTANCE_ID"] = instance_id
+    os.environ["PARTITION_LEASE_TTL"] = str(int(lease_ttl))
+    from replay import StubTelegram
+    from weather_fakes import FakeProvider, bot_module
+
+    # Один подписчик на город: номер подписчика совпадает с номером города
+    bot_module.user_subscriptions.update({str(index): [city] for index, city in enumerate(cities)})
+    bot_module.weather_router = bot_module.WeatherRouter(FakeProvider("fake"))
+    telegram = StubTelegram()
+    telegram.install(bot_module.bot)
+
+    async def run():
+        bot_module.Bot.set_current(bot_module.bot)
+        asyncio.create_task(bot_module.partition_heartbeat_loop())
+        await asyncio.sleep(digest_at - time.time())
+        await bot_module.run_daily_digest()
+        reports.put((instance_id, dict(telegram.messages_by_chat)))
+
+    asyncio.run(run())
+
+
+def collect(reports, since, timeout):
+    """
+    Собирает последние отчеты рабочих, полученные после момента since
+    """
+    latest = {}
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            instance_id, reported_at, owned = reports.get(timeout=0.1)
+        except Exception:
+            continue
+        if reported_at >= since:
+            latest[instance_id] = owned
+    return latest
+
+
+def check(latest, cities, expected_instances):
+    ownership = Counter(city for owned in latest.values() for city in owned)
+    duplicated = [city for city, count in ownership.items() if count > 1]
+    missing = [city for city in cities if city not in ownership]
+    print("  распределение: " + ", ".join(f"{instance_id}={len(owned)}" for instance_id, owned in sorted(latest.items())))
+
+    ok = set(latest) == set(expected_instances) and not duplicated and not missing
+    if duplicated:
+        print(f"  города у нескольких экземпляров: {duplicated[:10]}")
+    if missing:
+        print(f"  города без владельца: {missing[:10]}")
+    return ok
+
+
+def check_digest(delivered, cities):
+    deliveries = Counter()
+    for messages_by_chat in delivered.values():
+        deliveries.update(messages_by_chat)
+    print("  отправлено: " + ", ".join(
+        f"{instance_id}={sum(messages_by_chat.values())}" for instance_id, messages_by_chat in sorted(delivered.items())
+    ))
+
+    duplicated = [cities[chat_id] for chat_id, count in deliveries.items() if count > 1]
+    missing = [city for index, city in enumerate(cities) if index not in deliveries]
+    if duplicated:
+        print(f"  прогноз отправлен повторно: {duplicated[:10]}")
+    if missing:
+        print(f"  прогноз не отправлен: {missing[:10]}")
+    return not duplicated and not missing
+
+
+def digest_scenario(args, cities):
+    """
+    Роняет экземпляр перед утренней рассылкой и собирает отправленные остальными сообщения
+    """
+    db_path = os.path.join(tempfile.mkdtemp(), "partition.sqlite")
+    reports = multiprocessing.Queue()
+    instance_ids = [f"digest{index}" for index in range(args.workers)]
+    # Рассылка начинается, когда все экземпляры уже увидели друг друга
+    digest_at = time.time() + args.lease_ttl * 3
+    processes = {
+        instance_id: multiprocessing.Process(
+            target=digest_worker, args=(db_path, instance_id, cities, args.lease_ttl, digest_at, reports), daemon=True
+        )
+        for instance_id in instance_ids
+    }
+    for process in processes.values():
+        process.start()
+
+    # Экземпляр падает, когда остальные еще считают его живым
+    crashed = instance_ids[0]
+    time.sleep(max(0, digest_at - 0.2 - time.time()))
+    processes[crashed].kill()
+    print(f"Остановлен {crashed} перед утренней рассылкой")
+
+    delivered = {}
+    deadline = digest_at + args.lease_ttl * 4 / 3 + 30
+    while len(delivered) < len(instance_ids) - 1 and time.time() < deadline:
+        try:
+            instance_id, messages_by_chat = reports.get(timeout=0.1)
+        except Exception:
+            continue
+        delivered[instance_id] = messages_by_chat
+
+    for process in processes.values():
+        process.kill()
+    return delivered
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Проверка распределения городов между экземплярами")
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--cities", type=int, default=300)
+    parser.add_argument("--lease-ttl", type=float, default=2.0, help="время жизни аренды, с")
+    args = parser.parse_args()
+
+    db_path = os.path.join(tempfile.mkdtemp(), "partition.sqlite")
+    cities = [f"city{index}" for index in range(args.cities)]
+    reports = multiprocessing.Queue()
+    instance_ids = [f"worker{index}" for index in range(args.workers)]
+    processes = {
+        instance_id: multiprocessing.Process(
+            target=worker, args=(db_path, instance_id, cities, args.lease_ttl, reports), daemon=True
+        )
+        for instance_id in instance_ids
+    }
+    for process in processes.values():
+        process.start()
+
+    # Ждем, пока все экземпляры увидят друг друга и устаревшие аренды истекут
+    print(f"{args.workers} экземпляров, {args.cities} городов")
+    time.sleep(args.lease_ttl * 1.5)
+    ok = check(collect(reports, time.time(), args.lease_ttl), cities, instance_ids)
+
+    # Аварийно останавливаем один экземпляр: аренды остаются до истечения
+    crashed = instance_ids[0]
+    processes[crashed].kill()
+    crashed_at = time.time()
+    print(f"Остановлен {crashed}")
+    time.sleep(args.lease_ttl * 1.5)
+    survivors = instance_ids[1:]
+    ok = check(collect(reports, crashed_at + args.lease_ttl * 1.5, args.lease_ttl), cities, survivors) and ok
+
+    for process in processes.values():
+        process.kill()
+
+    print(f"Утренняя рассылка: {args.workers} экземпляров, {args.cities} городов")
+    ok = check_digest(digest_scenario(args, cities), cities) and ok
+
+    print("OK" if ok else "ОШИБКА")
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
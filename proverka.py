@@ -1,26 +1,44 @@
+from collections import OrderedDict, deque
 from datetime import datetime, timedelta
-from aiogram.types import ReplyKeyboardMarkup, KeyboardButton
+from aiogram.types import ReplyKeyboardMarkup, KeyboardButton, InlineKeyboardMarkup, InlineKeyboardButton
 import aiohttp  # Используем aiohttp для асинхронных запросов
 from aiogram import Bot, Dispatcher, types
 from aiogram.types import Message, ParseMode
 from aiogram.contrib.fsm_storage.memory import MemoryStorage
 from aiogram.dispatcher import FSMContext
 from aiogram.dispatcher.filters.state import State, StatesGroup
-from aiogram.utils import executor
+from aiogram.dispatcher.handler import CancelHandler
+from aiogram.dispatcher.middlewares import BaseMiddleware
+from aiogram.utils.exceptions import MessageNotModified, TelegramAPIError
+from array import array
 import asyncio
+import base64
+import bisect
+import concurrent.futures
+import contextlib
+import contextvars
+import functools
+import hashlib
+import itertools
 import json
+import math
+import socket
+import sqlite3
+import struct
+import zlib
 import random
 import os
+import time
 import logging
 
-from dotenv import load_dotenv
-
 # Настройка логирования
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
-# Константы
-load_dotenv()
+# Константы (файл .env читаем, только если секреты не заданы в окружении)
+if not os.getenv("BOT_TOKEN") or not os.getenv("ACCUWEATHER_API_KEY"):
+    from dotenv import load_dotenv
+    load_dotenv()
 TOKEN = os.getenv("BOT_TOKEN")
 ACCUWEATHER_API_KEY = os.getenv("ACCUWEATHER_API_KEY")
 
@@ -32,13 +50,282 @@ if not ACCUWEATHER_API_KEY:
     logger.error("Не найден ACCUWEATHER_API_KEY в переменных окружения")
     exit(1)
 
+# Один общий комментарий Нами на город в утренней рассылке (по умолчанию — свой для каждого подписчика)
+DIGEST_SHARED_COMMENTARY = os.getenv("DIGEST_SHARED_COMMENTARY", "0") == "1"
+# За сколько секунд до утренней рассылки начинать прогрев прогнозов подписанных городов
+DIGEST_PREFETCH_WINDOW = int(os.getenv("DIGEST_PREFETCH_WINDOW", "900"))
+# Сколько секунд считается актуальным закэшированный дневной прогноз
+DAILY_FORECAST_CACHE_TTL = int(os.getenv("DAILY_FORECAST_CACHE_TTL", "3600"))
+# Сколько секунд считаются актуальными закэшированные текущая погода и часовой прогноз
+CURRENT_WEATHER_CACHE_TTL = int(os.getenv("CURRENT_WEATHER_CACHE_TTL", "600"))
+HOURLY_FORECAST_CACHE_TTL = int(os.getenv("HOURLY_FORECAST_CACHE_TTL", "1800"))
+# Сколько секунд Telegram может кэшировать ответы на inline-запросы и за сколько мы обязаны ответить
+INLINE_CACHE_TIME = int(os.getenv("INLINE_CACHE_TIME", "600"))
+INLINE_ANSWER_DEADLINE = float(os.getenv("INLINE_ANSWER_DEADLINE", "2.5"))
+# Inline-запросы короче этого и те, что пользователь успел дописать за INLINE_TYPING_DELAY секунд,
+# обслуживаются только из кэша, без запросов к поставщику
+INLINE_MIN_QUERY_LENGTH = int(os.getenv("INLINE_MIN_QUERY_LENGTH", "3"))
+INLINE_TYPING_DELAY = float(os.getenv("INLINE_TYPING_DELAY", "0.7"))
+# Сколько городов показывать на кнопках и сколько недавних городов помнить (на пользователя и всего пользователей)
+QUICK_CITIES_LIMIT = int(os.getenv("QUICK_CITIES_LIMIT", "8"))
+RECENT_CITIES_PER_USER = int(os.getenv("RECENT_CITIES_PER_USER", "5"))
+RECENT_CITIES_USERS_LIMIT = int(os.getenv("RECENT_CITIES_USERS_LIMIT", "10000"))
+# Сколько городов можно добавить в подписку одним сообщением
+MAX_CITIES_PER_REQUEST = int(os.getenv("MAX_CITIES_PER_REQUEST", "10"))
+# Интервал проверки погоды фоновым мониторингом (сек)
+WEATHER_MONITOR_INTERVAL = int(os.getenv("WEATHER_MONITOR_INTERVAL", "7200"))
+# Файл и период (сек) снимков состояния в памяти для быстрого перезапуска
+STATE_SNAPSHOT_FILE = os.getenv("STATE_SNAPSHOT_FILE", "state_snapshot.bin")
+STATE_SNAPSHOT_INTERVAL = int(os.getenv("STATE_SNAPSHOT_INTERVAL", "600"))
+# Сколько секунд помнить отправленные уведомления
+NOTIFICATION_TTL = int(os.getenv("NOTIFICATION_TTL", str(48 * 3600)))
+# JSONL-файл для записи входящих обновлений и ответов AccuWeather (запись выключена, если не задан)
+TRAFFIC_RECORD_FILE = os.getenv("TRAFFIC_RECORD_FILE")
+# Быстрый старт: принимать обновления сразу, а подписки, снимок и фоновые задачи загружать в фоне
+FAST_START = os.getenv("FAST_START", "0") == "1"
+# Через сколько секунд после прогрева запускать фоновые задачи (в режиме быстрого старта)
+BACKGROUND_START_DELAY = int(os.getenv("BACKGROUND_START_DELAY", "10"))
+# Общая база SQLite для распределения городов между экземплярами (пусто — один экземпляр делает всё)
+PARTITION_DB = os.getenv("PARTITION_DB")
+# Идентификатор экземпляра и время жизни аренды (сек), после которого работа уходит другим
+INSTANCE_ID = os.getenv("INSTANCE_ID") or os.getenv("GAE_INSTANCE") or f"{socket.gethostname()}-{os.getpid()}"
+PARTITION_LEASE_TTL = int(os.getenv("PARTITION_LEASE_TTL", "600"))
+# Горизонт почасового ряда города (часов) и сколько последних ревизий прогноза в нем хранить
+SERIES_HORIZON_HOURS = int(os.getenv("SERIES_HORIZON_HOURS", "24"))
+SERIES_REVISIONS = int(os.getenv("SERIES_REVISIONS", "3"))
+# Запасной поставщик погоды для подстраховки медленных запросов к AccuWeather (пусто — без подстраховки).
+# Включается явно: запасной поставщик получает названия городов и координаты пользователей,
+# а бесплатный API Open-Meteo ("openmeteo") разрешен только для некоммерческого использования
+WEATHER_SECONDARY_PROVIDER = os.getenv("WEATHER_SECONDARY_PROVIDER", "")
+# После какого перцентиля задержки AccuWeather спрашивать запасного поставщика, с ограничениями задержки (сек)
+HEDGE_PERCENTILE = float(os.getenv("HEDGE_PERCENTILE", "95"))
+HEDGE_MIN_DELAY = float(os.getenv("HEDGE_MIN_DELAY", "0.3"))
+HEDGE_INITIAL_DELAY = float(os.getenv("HEDGE_INITIAL_DELAY", "1.5"))
+# Сколько секунд помнить, что поставщик не нашел город, и сколько таких названий помнить
+LOCATION_NOT_FOUND_TTL = int(os.getenv("LOCATION_NOT_FOUND_TTL", str(24 * 3600)))
+LOCATION_NOT_FOUND_LIMIT = int(os.getenv("LOCATION_NOT_FOUND_LIMIT", "10000"))
+# Одновременные запросы к поставщикам погоды и к Telegram: всего и сколько из них только для интерактивных запросов
+UPSTREAM_CONCURRENCY = int(os.getenv("UPSTREAM_CONCURRENCY", "10"))
+UPSTREAM_INTERACTIVE_RESERVED = int(os.getenv("UPSTREAM_INTERACTIVE_RESERVED", "3"))
+TELEGRAM_CONCURRENCY = int(os.getenv("TELEGRAM_CONCURRENCY", "20"))
+TELEGRAM_INTERACTIVE_RESERVED = int(os.getenv("TELEGRAM_INTERACTIVE_RESERVED", "5"))
+# Как часто (сек) писать в лог время ожидания по полосам
+LANE_METRICS_INTERVAL = int(os.getenv("LANE_METRICS_INTERVAL", "300"))
+# Ограничение частоты запросов пользователя: команды и кнопки, текстовые сообщения (в минуту и размер всплеска)
+THROTTLE_ENABLED = os.getenv("THROTTLE_ENABLED", "1") == "1"
+THROTTLE_COMMANDS_PER_MINUTE = float(os.getenv("THROTTLE_COMMANDS_PER_MINUTE", "10"))
+THROTTLE_COMMANDS_BURST = float(os.getenv("THROTTLE_COMMANDS_BURST", "5"))
+THROTTLE_TEXTS_PER_MINUTE = float(os.getenv("THROTTLE_TEXTS_PER_MINUTE", "6"))
+THROTTLE_TEXTS_BURST = float(os.getenv("THROTTLE_TEXTS_BURST", "3"))
+# Inline-запросы приходят на каждое нажатие клавиши, поэтому их лимит выше
+THROTTLE_INLINE_PER_MINUTE = float(os.getenv("THROTTLE_INLINE_PER_MINUTE", "30"))
+THROTTLE_INLINE_BURST = float(os.getenv("THROTTLE_INLINE_BURST", "15"))
+# Трансляция геопозиции: на сколько метров нужно сместиться, чтобы заново определить место и погоду,
+# и для скольких пользователей помнить последнее место
+LOCATION_REFETCH_DISTANCE = float(os.getenv("LOCATION_REFETCH_DISTANCE", "1000"))
+LOCATION_USERS_LIMIT = int(os.getenv("LOCATION_USERS_LIMIT", "10000"))
+# Через сколько секунд повторять неудавшийся запрос погоды по геопозиции (удваивается до CURRENT_WEATHER_CACHE_TTL)
+LOCATION_RETRY_DELAY = int(os.getenv("LOCATION_RETRY_DELAY", "60"))
+
+class CompactMemoryStorage(MemoryStorage):
+    """
+    MemoryStorage, который не создает пустую запись при чтении состояния:
+    иначе каждый написавший боту пользователь навсегда остается в памяти
+    """
+
+    async def get_state(self, *, chat=None, user=None, default=None):
+        chat, user = map(str, self.check_address(chat=chat, user=user))
+        entry = self.data.get(chat, {}).get(user)
+        if entry is None:
+            return self.resolve_state(default)
+        return entry.get("state", self.resolve_state(default))
+
+
+class Clock:
+    """
+    Источник времени для фоновых циклов и состояния бота.
+    Симуляция (simulate.py) подменяет его часами виртуального цикла событий
+    """
+
+    def now(self):
+        return datetime.now()
+
+    def time(self):
+        return time.time()
+
+    async def sleep(self, seconds):
+        await asyncio.sleep(seconds)
+
+
+clock = Clock()
+
+# Полоса текущей задачи: интерактивные обработчики или фоновые циклы
+current_lane = contextvars.ContextVar("lane", default="interactive")
+LANES = ("interactive", "background")
+# Список, в который slot() добавляет интервалы [начало, конец] ожидания слота в текущей задаче
+# и ее подзадачах; у еще идущего ожидания конец None
+slot_waits = contextvars.ContextVar("slot_waits", default=None)
+
+
+def background_lane(func):
+    """
+    Выполняет корутину в фоновой полосе: ее запросы к поставщикам погоды и Telegram
+    уступают очередь интерактивным
+    """
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        token = current_lane.set("background")
+        try:
+            return await func(*args, **kwargs)
+        finally:
+            current_lane.reset(token)
+    return wrapper
+
+
+def percentile(values, p):
+    ordered = sorted(values)
+    return ordered[int(p / 100 * (len(ordered) - 1))] if ordered else 0.0
+
+
+def covered_time(intervals, now):
+    """Суммарная длина объединения интервалов (параллельные ожидания не считаются дважды)"""
+    total, end = 0.0, None
+    for begin, finish in sorted((begin, now if finish is None else finish) for begin, finish in intervals):
+        if end is None or begin > end:
+            total += finish - begin
+            end = finish
+        elif finish > end:
+            total += finish - end
+            end = finish
+    return total
+
+
+class LaneLimiter:
+    """
+    Ограничивает число одновременных запросов к внешнему API.
+
+    Интерактивная полоса может занять любой из total слотов, фоновая — не больше
+    total - reserved и только когда нет ожидающих интерактивных запросов.
+    Освободившийся слот достается сначала интерактивной очереди
+    """
+
+    def __init__(self, name, total, reserved):
+        self.name = name
+        self.total = total
+        self.reserved = min(reserved, total - 1)
+        self.active = {lane: 0 for lane in LANES}
+        self.waiters = {lane: deque() for lane in LANES}
+        self.waits = {lane: [] for lane in LANES}  # время ожидания слота с последнего отчета
+
+    def can_start(self, lane):
+        if sum(self.active.values()) >= self.total:
+            return False
+        if lane == "background":
+            return not self.waiters["interactive"] and self.active["background"] < self.total - self.reserved
+        return True
+
+    def wake(self):
+        for lane in LANES:
+            while self.waiters[lane] and self.can_start(lane):
+                waiter = self.waiters[lane].popleft()
+                if not waiter.done():
+                    self.active[lane] += 1
+                    waiter.set_result(None)
+
+    @contextlib.asynccontextmanager
+    async def slot(self):
+        lane = current_lane.get()
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        if not self.waiters[lane] and self.can_start(lane):
+            self.active[lane] += 1
+        else:
+            waiter = loop.create_future()
+            self.waiters[lane].append(waiter)
+            interval = [started, None]
+            waits = slot_waits.get()
+            if waits is not None:
+                waits.append(interval)
+            try:
+                await waiter
+            except asyncio.CancelledError:
+                if waiter in self.waiters[lane]:
+                    self.waiters[lane].remove(waiter)
+                elif not waiter.cancelled():
+                    # Слот уже выдан, но задачу отменили
+                    self.active[lane] -= 1
+                    self.wake()
+                raise
+            finally:
+                interval[1] = loop.time()
+        self.waits[lane].append(loop.time() - started)
+
+        try:
+            yield
+        finally:
+            self.active[lane] -= 1
+            self.wake()
+
+    def report(self):
+        """
+        Возвращает строку с ожиданием слотов по полосам и сбрасывает накопленные замеры
+        """
+        parts = []
+        for lane in LANES:
+            waits, self.waits[lane] = self.waits[lane], []
+            parts.append(
+                f"{lane}: {len(waits)} запросов, ожидание p50 {percentile(waits, 50) * 1000:.0f} мс, "
+                f"p99 {percentile(waits, 99) * 1000:.0f} мс, max {max(waits, default=0) * 1000:.0f} мс"
+            )
+        return f"{self.name}: " + "; ".join(parts)
+
+
+# Полосы для запросов к поставщикам погоды и к Bot API
+upstream_lanes = LaneLimiter("Поставщики погоды", UPSTREAM_CONCURRENCY, UPSTREAM_INTERACTIVE_RESERVED)
+telegram_lanes = LaneLimiter("Telegram", TELEGRAM_CONCURRENCY, TELEGRAM_INTERACTIVE_RESERVED)
+
+# Методы Bot API вне полос: long polling держит соединение долго и не должен занимать слот
+LANE_EXEMPT_METHODS = {"getUpdates"}
+
+
+class LaneBot(Bot):
+    """
+    Bot, который отправляет запросы к Bot API через полосы telegram_lanes.
+    Сам запрос выполняет send_request (его подменяют заглушки в replay.py)
+    """
+
+    async def request(self, method, data=None, files=None, **kwargs):
+        if method in LANE_EXEMPT_METHODS:
+            return await self.send_request(method, data, files, **kwargs)
+        async with telegram_lanes.slot():
+            return await self.send_request(method, data, files, **kwargs)
+
+    async def send_request(self, method, data=None, files=None, **kwargs):
+        return await super().request(method, data, files, **kwargs)
+
+
+async def metrics_loop():
+    """
+    Периодически пишет в лог время ожидания слотов по полосам и число отклоненных запросов
+    """
+    while True:
+        await clock.sleep(LANE_METRICS_INTERVAL)
+        for limiter in (upstream_lanes, telegram_lanes):
+            logger.info(limiter.report())
+        if throttling:
+            logger.info(throttling.report())
+
+
 # Инициализация бота и диспетчера
-bot = Bot(token=TOKEN)
-storage = MemoryStorage()
+bot = LaneBot(token=TOKEN)
+storage = CompactMemoryStorage()
 dp = Dispatcher(bot, storage=storage)
 
 # Словарь для хранения последних данных о погоде с ограничением по времени
-last_weather = {}  # {user_id: {город: {час: {desc: str, timestamp: float}}}}
+last_weather = {}  # {user_id: {город: {"sent_notifications": {ключ: время отправки}}}}
+
+# Состояние фонового мониторинга
+monitor_state = {"last_cycle": 0.0}  # время последнего цикла weather_monitor
 
 # Файл для хранения подписок
 SUBSCRIPTIONS_FILE = "subscriptions.json"
@@ -46,6 +333,179 @@ SUBSCRIPTIONS_FILE = "subscriptions.json"
 # Словарь для кэширования location key городов (чтобы уменьшить количество запросов)
 city_location_keys = {}  # {city_name: location_key}
 
+# Кэш данных о погоде в общем виде (см. WeatherProvider)
+response_cache = {}  # {(вид данных, город): {"data": ..., "timestamp": float, "provider": имя поставщика}}
+
+# Время жизни данных в кэше по виду
+RESPONSE_CACHE_TTL = {
+    "current": CURRENT_WEATHER_CACHE_TTL,
+    "hourly": HOURLY_FORECAST_CACHE_TTL,
+    "daily": DAILY_FORECAST_CACHE_TTL,
+}
+
+
+def get_cached_response(kind, city):
+    """
+    Возвращает закэшированный ответ API, если он еще актуален
+    """
+    entry = response_cache.get((kind, city))
+    if entry and clock.time() - entry["timestamp"] < RESPONSE_CACHE_TTL[kind]:
+        return entry["data"]
+    return None
+
+
+def get_cached_provider(kind, city):
+    """Поставщик, ответивший данными из кэша (None для записей без него)"""
+    entry = response_cache.get((kind, city))
+    return entry.get("provider") if entry else None
+
+
+def store_cached_response(kind, city, data, provider=None):
+    response_cache[(kind, city)] = {"data": data, "timestamp": clock.time(), "provider": provider}
+
+
+# Запись трафика для последующего воспроизведения (см. replay.py)
+traffic_record = {"file": None}
+
+
+def redact_secrets(text):
+    """
+    Убирает токен бота и ключ AccuWeather из записываемых данных
+    """
+    for secret in (TOKEN, ACCUWEATHER_API_KEY):
+        text = text.replace(secret, "<redacted>")
+    return text
+
+
+def record_traffic(kind, payload):
+    """
+    Дописывает событие в JSONL-файл записи трафика, если запись включена
+    """
+    if not TRAFFIC_RECORD_FILE:
+        return
+    try:
+        if traffic_record["file"] is None:
+            traffic_record["file"] = open(TRAFFIC_RECORD_FILE, "a", encoding="utf-8", buffering=1)
+        entry = json.dumps({"t": time.time(), "kind": kind, **payload}, ensure_ascii=False, default=str)
+        traffic_record["file"].write(redact_secrets(entry) + "\n")
+    except Exception as e:
+        logger.error(f"Ошибка записи трафика: {e}")
+
+
+class TrafficRecorderMiddleware(BaseMiddleware):
+    """
+    Записывает все входящие обновления Telegram
+    """
+
+    async def on_pre_process_update(self, update: types.Update, data: dict):
+        record_traffic("update", {"update": update.to_python()})
+
+
+# Лимиты запросов пользователя по виду обновления: (токенов в минуту, размер корзины)
+THROTTLE_LIMITS = {
+    "command": (THROTTLE_COMMANDS_PER_MINUTE, THROTTLE_COMMANDS_BURST),
+    "text": (THROTTLE_TEXTS_PER_MINUTE, THROTTLE_TEXTS_BURST),
+    "inline": (THROTTLE_INLINE_PER_MINUTE, THROTTLE_INLINE_BURST),
+}
+
+
+class UserBucket:
+    """
+    Корзины токенов одного пользователя: остаток по каждому виду обновлений,
+    время последнего пополнения и виды, по которым пользователь уже предупрежден
+    """
+    __slots__ = ("command", "text", "inline", "updated", "warned")
+
+    def __init__(self, now):
+        self.command = THROTTLE_LIMITS["command"][1]
+        self.text = THROTTLE_LIMITS["text"][1]
+        self.inline = THROTTLE_LIMITS["inline"][1]
+        self.updated = now
+        self.warned = ()
+
+
+class ThrottlingMiddleware(BaseMiddleware):
+    """
+    Ограничивает частоту команд (и нажатий кнопок) и текстовых сообщений каждого
+    пользователя корзиной токенов. Первый лишний запрос получает короткий ответ без
+    обращения к API, следующие отбрасываются молча, пока корзина не пополнится
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.buckets = OrderedDict()  # {user_id: UserBucket}, от давно не писавших к недавним
+        self.throttled = {kind: 0 for kind in THROTTLE_LIMITS}
+        # Через столько секунд простоя корзины снова полные, и хранить их незачем
+        self.idle_ttl = max(burst * 60 / rate for rate, burst in THROTTLE_LIMITS.values())
+
+    def consume(self, user_id, kind):
+        """
+        Списывает токен. Возвращает None, если запрос разрешен, иначе
+        сколько секунд ждать следующего токена
+        """
+        now = clock.time()
+        while self.buckets:
+            oldest = next(iter(self.buckets.values()))
+            if now - oldest.updated < self.idle_ttl:
+                break
+            self.buckets.popitem(last=False)
+
+        bucket = self.buckets.pop(user_id, None) or UserBucket(now)
+        self.buckets[user_id] = bucket
+        for bucket_kind, (rate, burst) in THROTTLE_LIMITS.items():
+            tokens = getattr(bucket, bucket_kind) + (now - bucket.updated) * rate / 60
+            setattr(bucket, bucket_kind, min(burst, tokens))
+        bucket.updated = now
+
+        tokens = getattr(bucket, kind)
+        if tokens >= 1:
+            setattr(bucket, kind, tokens - 1)
+            bucket.warned = tuple(warned for warned in bucket.warned if warned != kind)
+            return None
+        return (1 - tokens) * 60 / THROTTLE_LIMITS[kind][0]
+
+    async def throttle(self, user_id, kind, reply):
+        wait = self.consume(user_id, kind)
+        if wait is None:
+            return
+
+        self.throttled[kind] += 1
+        bucket = self.buckets[user_id]
+        if kind not in bucket.warned:
+            bucket.warned += (kind,)
+            logger.warning(f"Пользователь {user_id} превысил лимит запросов ({kind})")
+            await reply(f"⏳ Слишком много запросов. Попробуйте через {math.ceil(wait)} сек.")
+        raise CancelHandler()
+
+    async def on_pre_process_message(self, message: types.Message, data: dict):
+        kind = "command" if message.is_command() else "text"
+        await self.throttle(message.from_user.id, kind, message.answer)
+
+    async def on_pre_process_callback_query(self, call: types.CallbackQuery, data: dict):
+        await self.throttle(call.from_user.id, "command", call.answer)
+
+    async def on_pre_process_inline_query(self, inline_query: types.InlineQuery, data: dict):
+        async def reply(text):
+            # Текст в inline-режиме можно показать только кнопкой над результатами
+            await inline_query.answer(
+                [], cache_time=5, is_personal=True, switch_pm_text=text, switch_pm_parameter="throttled"
+            )
+
+        await self.throttle(inline_query.from_user.id, "inline", reply)
+
+    def report(self):
+        """
+        Возвращает строку с числом отклоненных обновлений и сбрасывает счетчики
+        """
+        throttled, self.throttled = self.throttled, {kind: 0 for kind in THROTTLE_LIMITS}
+        return (
+            f"Ограничение запросов: отклонено команд {throttled['command']}, текстов {throttled['text']}, "
+            f"inline-запросов {throttled['inline']}, корзин в памяти {len(self.buckets)}"
+        )
+
+
+throttling = ThrottlingMiddleware() if THROTTLE_ENABLED else None
+
 
 # Функция загрузки подписок при старте
 def load_subscriptions():
@@ -66,17 +526,380 @@ def save_subscriptions(user_subs):
         logger.error(f"Ошибка сохранения JSON: {e}")
 
 
-# Загружаем подписки при старте
-user_subscriptions = load_subscriptions()
+# Подписки загружаются при первом обращении или во время прогрева после старта
+user_subscriptions = {}
+subscriptions_state = {"loaded": False}
+subscriptions_lock = asyncio.Lock()
+
+
+async def ensure_subscriptions_loaded():
+    """
+    Загружает подписки из файла при первом обращении, не блокируя цикл событий
+    """
+    if subscriptions_state["loaded"]:
+        return
+    async with subscriptions_lock:
+        if not subscriptions_state["loaded"]:
+            loaded = await asyncio.get_running_loop().run_in_executor(None, load_subscriptions)
+            for user_id, cities in loaded.items():
+                user_subscriptions.setdefault(user_id, cities)
+            subscriptions_state["loaded"] = True
+
+# Формат снимка: сигнатура, версия, затем сжатый JSON.
+# В снимке только простые данные: его чтение не исполняет код и не зависит от имени модуля
+SNAPSHOT_MAGIC = b"NAMISNAP"
+SNAPSHOT_VERSION = 5
+SNAPSHOT_HEADER = struct.Struct(">8sH")
+
+
+def encode_snapshot_value(value):
+    # Время в данных о погоде (поля "time" и "date" общего вида)
+    if isinstance(value, datetime):
+        return {"__datetime__": value.isoformat()}
+    raise TypeError(f"{type(value).__name__} нельзя сохранить в снимок")
+
+
+def decode_snapshot_object(obj):
+    if "__datetime__" in obj:
+        return datetime.fromisoformat(obj["__datetime__"])
+    return obj
+
+
+def save_state_snapshot():
+    """
+    Сохраняет кэши и состояние мониторинга в компактный бинарный снимок
+    """
+    state = {
+        "created": clock.time(),
+        "city_location_keys": city_location_keys,
+        "last_weather": last_weather,
+        "city_series": {city: series.to_state() for city, series in city_series.items()},
+        "response_cache": [[kind, city, entry] for (kind, city), entry in response_cache.items()],
+        "monitor_state": monitor_state,
+    }
+    try:
+        text = json.dumps(state, ensure_ascii=False, separators=(",", ":"), default=encode_snapshot_value)
+        payload = zlib.compress(text.encode("utf-8"))
+        tmp_file = f"{STATE_SNAPSHOT_FILE}.tmp"
+        with open(tmp_file, "wb") as f:
+            f.write(SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION))
+            f.write(payload)
+        os.replace(tmp_file, STATE_SNAPSHOT_FILE)
+    except Exception as e:
+        logger.error(f"Ошибка сохранения снимка состояния: {e}")
+
+
+def expire_stale_state(now_ts):
+    """
+    Удаляет из состояния устаревшие прогнозы, кэш и уведомления
+    """
+    for cities in last_weather.values():
+        for city_state in cities.values():
+            city_state["sent_notifications"] = {
+                key: sent_at for key, sent_at in city_state["sent_notifications"].items()
+                if now_ts - sent_at < NOTIFICATION_TTL
+            }
+
+    stale_keys = [
+        key for key, entry in response_cache.items()
+        if now_ts - entry["timestamp"] >= RESPONSE_CACHE_TTL.get(key[0], 0)
+    ]
+    for key in stale_keys:
+        del response_cache[key]
+
+    # Ряды городов, которые давно не обновлялись, больше не нужны
+    stale_cities = [
+        city for city, series in city_series.items()
+        if now_ts - series.fetched_at[series.latest] >= NOTIFICATION_TTL
+    ]
+    for city in stale_cities:
+        del city_series[city]
+
+
+def read_state_snapshot():
+    """
+    Читает снимок состояния, если он есть и совпадает по версии
+    """
+    try:
+        with open(STATE_SNAPSHOT_FILE, "rb") as f:
+            header = f.read(SNAPSHOT_HEADER.size)
+            payload = f.read()
+    except FileNotFoundError:
+        logger.info(f"Снимок состояния {STATE_SNAPSHOT_FILE} не найден, холодный старт")
+        return None
+
+    try:
+        magic, version = SNAPSHOT_HEADER.unpack(header)
+        if magic != SNAPSHOT_MAGIC or version != SNAPSHOT_VERSION:
+            logger.warning(f"Снимок состояния версии {version} не поддерживается, холодный старт")
+            return None
+        state = json.loads(zlib.decompress(payload).decode("utf-8"), object_hook=decode_snapshot_object)
+        state["city_series"] = {
+            city: CitySeries.from_state(series_state) for city, series_state in state["city_series"].items()
+        }
+        state["response_cache"] = {(kind, city): entry for kind, city, entry in state["response_cache"]}
+        return state
+    except Exception as e:
+        logger.error(f"Ошибка чтения снимка состояния: {e}")
+        return None
+
+
+def restore_state_snapshot(state):
+    """
+    Восстанавливает кэши и состояние мониторинга из прочитанного снимка
+    """
+    city_location_keys.update(state["city_location_keys"])
+    last_weather.update(state["last_weather"])
+    city_series.update(state["city_series"])
+    response_cache.update(state["response_cache"])
+    monitor_state.update(state["monitor_state"])
+    expire_stale_state(clock.time())
+
+    logger.info(
+        f"Состояние восстановлено из снимка от {datetime.fromtimestamp(state['created']):%d.%m %H:%M}: "
+        f"{len(city_location_keys)} городов, {len(response_cache)} ответов в кэше"
+    )
+
+
+async def snapshot_loop():
+    """
+    Периодически убирает устаревшее состояние и сохраняет снимок
+    """
+    while True:
+        await clock.sleep(STATE_SNAPSHOT_INTERVAL)
+        expire_stale_state(clock.time())
+        save_state_snapshot()
+
+
+class CityPartitioner:
+    """
+    Распределяет города между экземплярами бота по консистентному хешированию.
+    Живые экземпляры и аренды городов хранятся в общей базе SQLite: экземпляр,
+    переставший продлевать аренду, выпадает из кольца, и его города забирают другие.
+    Там же хранятся отправленные события уведомлений и утренние рассылки по городам,
+    чтобы новый владелец города не повторял их.
+
+    Методы синхронные (их использует partition_check.py); из бота они вызываются
+    через run() в отдельном потоке, чтобы ожидание блокировки базы не останавливало цикл событий
+    """
+
+    VIRTUAL_NODES = 64  # точек на кольце на каждый экземпляр
+
+    def __init__(self, db_path, instance_id, lease_ttl):
+        self.instance_id = instance_id
+        self.lease_ttl = lease_ttl
+        self._ring = []  # отсортированный список (хеш, instance_id)
+        # Все обращения к соединению идут из одного потока этого пула
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="partitioner")
+        self._conn = sqlite3.connect(db_path, timeout=30, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS instances (instance_id TEXT PRIMARY KEY, expires_at REAL)")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS leases (city TEXT PRIMARY KEY, owner TEXT, expires_at REAL)")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS sent_alerts (city TEXT, event_id TEXT, sent_at REAL, PRIMARY KEY (city, event_id))"
+        )
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS sent_digests (city TEXT, day TEXT, sent_at REAL, PRIMARY KEY (city, day))"
+        )
+
+    async def run(self, method, *args):
+        """Выполняет метод в потоке разделителя, не блокируя цикл событий"""
+        return await asyncio.get_running_loop().run_in_executor(self._executor, getattr(self, method), *args)
+
+    @staticmethod
+    def _hash(value):
+        return int.from_bytes(hashlib.md5(value.encode("utf-8")).digest()[:8], "big")
+
+    def heartbeat(self):
+        """
+        Продлевает аренду экземпляра и перестраивает кольцо по живым экземплярам
+        """
+        now = clock.time()
+        with self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO instances (instance_id, expires_at) VALUES (?, ?)",
+                (self.instance_id, now + self.lease_ttl)
+            )
+            self._conn.execute("DELETE FROM instances WHERE expires_at < ?", (now,))
+            live_instances = [row[0] for row in self._conn.execute("SELECT instance_id FROM instances")]
+
+        self._ring = sorted(
+            (self._hash(f"{instance_id}#{node}"), instance_id)
+            for instance_id in live_instances
+            for node in range(self.VIRTUAL_NODES)
+        )
+
+    def owner(self, city):
+        """
+        Возвращает экземпляр, которому город принадлежит по кольцу
+        """
+        if not self._ring:
+            return self.instance_id
+        index = bisect.bisect(self._ring, (self._hash(city), "")) % len(self._ring)
+        return self._ring[index][1]
+
+    def acquire(self, cities):
+        """
+        Берет или продлевает аренду своих по кольцу городов и возвращает те, что удалось получить
+        """
+        now = clock.time()
+        mine = [city for city in cities if self.owner(city) == self.instance_id]
+        acquired = set()
+        with self._conn:
+            for city in mine:
+                # Чужую аренду можно забрать только после ее истечения
+                self._conn.execute(
+                    "INSERT INTO leases (city, owner, expires_at) VALUES (?, ?, ?) "
+                    "ON CONFLICT(city) DO UPDATE SET owner = excluded.owner, expires_at = excluded.expires_at "
+                    "WHERE leases.owner = excluded.owner OR leases.expires_at < ?",
+                    (city, self.instance_id, now + self.lease_ttl, now)
+                )
+                row = self._conn.execute("SELECT owner FROM leases WHERE city = ?", (city,)).fetchone()
+                if row and row[0] == self.instance_id:
+                    acquired.add(city)
+        return acquired
+
+    def sent_alerts(self, cities):
+        """
+        Возвращает уже отправленные события городов: {город: {id события: время отправки}}
+        """
+        sent = {}
+        for city in cities:
+            rows = self._conn.execute("SELECT event_id, sent_at FROM sent_alerts WHERE city = ?", (city,))
+            sent[city] = dict(rows.fetchall())
+        return sent
+
+    def record_sent_alerts(self, sent, expire_before):
+        """
+        Запоминает отправленные события {город: {id события: время отправки}} и удаляет устаревшие
+        """
+        with self._conn:
+            self._conn.executemany(
+                "INSERT OR IGNORE INTO sent_alerts (city, event_id, sent_at) VALUES (?, ?, ?)",
+                [(city, event_id, sent_at) for city, events in sent.items() for event_id, sent_at in events.items()]
+            )
+            self._conn.execute("DELETE FROM sent_alerts WHERE sent_at < ?", (expire_before,))
+
+    def sent_digests(self, cities, day):
+        """
+        Возвращает города, по которым утренняя рассылка за день day уже прошла
+        """
+        sent = set()
+        for city in cities:
+            row = self._conn.execute("SELECT 1 FROM sent_digests WHERE city = ? AND day = ?", (city, day)).fetchone()
+            if row:
+                sent.add(city)
+        return sent
+
+    def record_sent_digest(self, city, day, expire_before):
+        """
+        Отмечает утреннюю рассылку по городу за день day и удаляет устаревшие отметки
+        """
+        with self._conn:
+            self._conn.execute(
+                "INSERT OR IGNORE INTO sent_digests (city, day, sent_at) VALUES (?, ?, ?)",
+                (city, day, clock.time())
+            )
+            self._conn.execute("DELETE FROM sent_digests WHERE sent_at < ?", (expire_before,))
+
+    def release(self):
+        """
+        Освобождает аренды при остановке, чтобы работа сразу перешла к другим экземплярам
+        """
+        with self._conn:
+            self._conn.execute("DELETE FROM instances WHERE instance_id = ?", (self.instance_id,))
+            self._conn.execute("DELETE FROM leases WHERE owner = ?", (self.instance_id,))
+
+
+partitioner = CityPartitioner(PARTITION_DB, INSTANCE_ID, PARTITION_LEASE_TTL) if PARTITION_DB else None
+
+
+async def get_owned_cities(cities):
+    """
+    Оставляет города, которые фоновые задачи этого экземпляра должны обрабатывать
+    """
+    if partitioner is None:
+        return set(cities)
+    try:
+        return await partitioner.run("acquire", list(cities))
+    except sqlite3.Error as e:
+        # Без общей базы не беремся за работу, чтобы не дублировать другие экземпляры
+        logger.error(f"Ошибка получения аренды городов: {e}")
+        return set()
+
+
+async def get_shared_sent_alerts(cities):
+    """
+    Отправленные другими экземплярами события городов, перешедших к этому экземпляру
+    """
+    if partitioner is None or not cities:
+        return {}
+    try:
+        return await partitioner.run("sent_alerts", list(cities))
+    except sqlite3.Error as e:
+        logger.error(f"Ошибка чтения отправленных уведомлений: {e}")
+        return {}
+
+
+async def share_sent_alerts(sent):
+    if partitioner is None or not sent:
+        return
+    try:
+        await partitioner.run("record_sent_alerts", sent, clock.time() - NOTIFICATION_TTL)
+    except sqlite3.Error as e:
+        logger.error(f"Ошибка сохранения отправленных уведомлений: {e}")
+
+
+async def get_sent_digests(cities, day):
+    """
+    Города, по которым утренняя рассылка за день уже прошла на любом из экземпляров
+    """
+    if partitioner is None or not cities:
+        return set()
+    try:
+        return await partitioner.run("sent_digests", list(cities), day)
+    except sqlite3.Error as e:
+        logger.error(f"Ошибка чтения отправленных утренних рассылок: {e}")
+        return set()
+
+
+async def share_sent_digest(city, day):
+    if partitioner is None:
+        return
+    try:
+        await partitioner.run("record_sent_digest", city, day, clock.time() - NOTIFICATION_TTL)
+    except sqlite3.Error as e:
+        logger.error(f"Ошибка сохранения утренней рассылки по городу {city}: {e}")
+
+
+async def partition_heartbeat():
+    """
+    Подтверждает, что экземпляр жив; ошибка базы не должна останавливать вызывающую задачу
+    """
+    try:
+        await partitioner.run("heartbeat")
+    except sqlite3.Error as e:
+        logger.error(f"Ошибка продления аренды экземпляра {INSTANCE_ID}: {e}")
+
+
+async def partition_heartbeat_loop():
+    """
+    Периодически подтверждает, что экземпляр жив
+    """
+    while True:
+        await partition_heartbeat()
+        await clock.sleep(PARTITION_LEASE_TTL / 3)
 
 
 # Состояния для работы с ботом
 class WeatherForm(StatesGroup):
-    waiting_for_city_now = State()
-    waiting_for_city_forecast = State()
-    waiting_for_city_day = State()
     waiting_for_subscribe_city = State()
-    waiting_for_unsubscribe_city = State()
+
+
+if TRAFFIC_RECORD_FILE:
+    dp.middleware.setup(TrafficRecorderMiddleware())
+if throttling:
+    dp.middleware.setup(throttling)
 
 
 # Создание клавиатуры с местоположением
@@ -99,175 +922,577 @@ async def start(message: types.Message):
     )
 
 
-# Функция для получения location key по названию города
-async def get_location_key(city):
-    if city in city_location_keys:
-        return city_location_keys[city]
+# HTTP-запрос к поставщику погоды: возвращает статус и JSON-ответ (None при ошибке)
+async def api_get(url):
+    async with upstream_lanes.slot(), session.get(url) as response:
+        data = await response.json() if response.status == 200 else None
+    record_traffic("api", {"url": url, "status": response.status, "data": data})
+    return response.status, data
 
-    try:
-        url = f'http://dataservice.accuweather.com/locations/v1/cities/search?apikey={ACCUWEATHER_API_KEY}&q={city}&language=ru'
-        async with session.get(url) as response:
-            if response.status == 200:
-                data = await response.json()
-                if data and len(data) > 0:
-                    # Сохраняем в кэш
-                    location_key = data[0]['Key']
-                    city_location_keys[city] = location_key
-                    return location_key
-                else:
-                    logger.warning(f"Город {city} не найден")
-                    return None
-            else:
-                logger.warning(f"Ошибка получения location key для {city}: {response.status}")
-                return None
-    except Exception as e:
-        logger.error(f"Ошибка запроса location key: {e}")
-        return None
 
+def parse_local_time(value):
+    """Время из ответа поставщика как местное время без часового пояса"""
+    return datetime.fromisoformat(value).replace(tzinfo=None)
 
-# Асинхронная функция для получения текущей погоды
-async def fetch_current_weather(city):
-    try:
-        location_key = await get_location_key(city)
-        if not location_key:
+
+class ProviderError(Exception):
+    """Поставщик не ответил по существу (ошибка HTTP): в отличие от пустого ответа, повод спросить запасного"""
+
+
+class WeatherProvider:
+    """
+    Поставщик погоды. Все методы возвращают данные в общем виде или None:
+
+    - текущая погода: {"time", "temp", "desc", "wind_speed", "is_day"}
+    - почасовой прогноз: список {"time", "temp", "desc", "wind_speed", "precip_prob", "is_day"}
+    - прогноз на сегодня: {"date", "min_temp", "max_temp", "day": {...}, "night": {...}},
+      где day/night — {"desc", "wind_speed", "precip_prob"}
+
+    Время — местное время города без часового пояса; precip_prob равно None, если неизвестно.
+    Локация (результат search/geoposition) — внутреннее значение поставщика
+    """
+    name = "base"
+
+    def __init__(self):
+        self.locations = {}  # {город: локация у этого поставщика}
+        self.not_found = OrderedDict()  # {город: когда поставщик его не нашел}, от давних к недавним
+
+    async def search(self, city):
+        raise NotImplementedError
+
+    async def geoposition(self, lat, lon):
+        """Возвращает (локация, название места) или None"""
+        raise NotImplementedError
+
+    async def current(self, location):
+        raise NotImplementedError
+
+    async def hourly(self, location):
+        raise NotImplementedError
+
+    async def daily(self, location):
+        raise NotImplementedError
+
+    async def locate(self, city):
+        if city in self.locations:
+            return self.locations[city]
+        missed_at = self.not_found.get(city)
+        if missed_at is not None and clock.time() - missed_at < LOCATION_NOT_FOUND_TTL:
             return None
 
-        url = f'http://dataservice.accuweather.com/currentconditions/v1/{location_key}?apikey={ACCUWEATHER_API_KEY}&language=ru&details=true'
-        async with session.get(url) as response:
-            if response.status == 200:
-                data = await response.json()
-                if data and len(data) > 0:
-                    return data[0]
-                else:
-                    logger.warning(f"Нет данных о текущей погоде для {city}")
-                    return None
-            else:
-                logger.warning(f"Ошибка получения текущей погоды для {city}: {response.status}")
-                return None
-    except Exception as e:
-        logger.error(f"Ошибка запроса текущей погоды: {e}")
-        return None
+        location = await self.search(city)
+        if not location:
+            # Запоминаем отрицательный ответ, чтобы не искать то же слово снова
+            self.not_found.pop(city, None)
+            self.not_found[city] = clock.time()
+            while len(self.not_found) > LOCATION_NOT_FOUND_LIMIT:
+                self.not_found.popitem(last=False)
+            return None
+        self.not_found.pop(city, None)
+        self.locations[city] = location
+        return location
+
+    async def fetch(self, kind, city):
+        """Данные вида kind ("current", "hourly", "daily") для города"""
+        location = await self.locate(city)
+        if not location:
+            return None
+        return await getattr(self, kind)(location)
+
+    async def fetch_many(self, kinds, city):
+        """
+        Данные нескольких видов для города: (поставщик, {вид: данные}) с только полученными
+        видами или None. Локация ищется один раз, запросы строит collect()
+        """
+        location = await self.locate(city)
+        if not location:
+            return None
+        found = await self.collect(kinds, location)
+        return (self.name, found) if found else None
+
+    async def collect(self, kinds, location):
+        """
+        Запрашивает виды данных для локации. По умолчанию каждый вид — отдельный запрос;
+        поставщик, у которого один ответ покрывает несколько видов, переопределяет метод
+        """
+        results = await asyncio.gather(*(getattr(self, kind)(location) for kind in kinds))
+        return {kind: data for kind, data in zip(kinds, results) if data}
+
+    async def fetch_at(self, kind, lat, lon):
+        """
+        Возвращает (поставщик, локация, название места, данные вида kind) для координат или None.
+        Локацию можно передать обратно этому же поставщику через WeatherRouter.request_from
+        """
+        found = await self.geoposition(lat, lon)
+        if not found:
+            return None
+        location, place = found
+        data = await getattr(self, kind)(location)
+        return (self.name, location, place, data) if data else None
 
 
-# Асинхронная функция для получения прогноза на 12 часов
-async def fetch_hourly_forecast(city):
-    try:
-        location_key = await get_location_key(city)
-        if not location_key:
+class AccuWeatherProvider(WeatherProvider):
+    name = "accuweather"
+
+    URLS = {
+        "search": "http://dataservice.accuweather.com/locations/v1/cities/search?apikey={api_key}&q={query}&language=ru",
+        "geoposition": "http://dataservice.accuweather.com/locations/v1/cities/geoposition/search?apikey={api_key}&q={query}&language=ru",
+        "current": "http://dataservice.accuweather.com/currentconditions/v1/{location}?apikey={api_key}&language=ru&details=true",
+        "hourly": "http://dataservice.accuweather.com/forecasts/v1/hourly/12hour/{location}?apikey={api_key}&language=ru&details=true&metric=true",
+        "daily": "http://dataservice.accuweather.com/forecasts/v1/daily/1day/{location}?apikey={api_key}&language=ru&details=true&metric=true",
+    }
+
+    def __init__(self, api_key):
+        super().__init__()
+        self.api_key = api_key
+        # location key городов попадают в снимок состояния
+        self.locations = city_location_keys
+
+    async def get(self, endpoint, **params):
+        url = self.URLS[endpoint].format(api_key=self.api_key, **params)
+        status, data = await api_get(url)
+        if status != 200:
+            raise ProviderError(f"AccuWeather: ошибка запроса {endpoint}: {status}")
+        return data
+
+    async def search(self, city):
+        data = await self.get("search", query=city)
+        if not data:
+            logger.warning(f"Город {city} не найден")
             return None
+        return data[0]['Key']
 
-        url = f'http://dataservice.accuweather.com/forecasts/v1/hourly/12hour/{location_key}?apikey={ACCUWEATHER_API_KEY}&language=ru&details=true&metric=true'
-        async with session.get(url) as response:
-            if response.status == 200:
-                data = await response.json()
-                if data and len(data) > 0:
-                    return data
-                else:
-                    logger.warning(f"Нет данных о часовом прогнозе для {city}")
-                    return None
-            else:
-                logger.warning(f"Ошибка получения часового прогноза для {city}: {response.status}")
-                return None
-    except Exception as e:
-        logger.error(f"Ошибка запроса часового прогноза: {e}")
-        return None
+    async def geoposition(self, lat, lon):
+        data = await self.get("geoposition", query=f"{lat},{lon}")
+        if not data or 'Key' not in data:
+            logger.warning(f"Не удалось получить информацию о локации для координат {lat}, {lon}")
+            return None
+        return data['Key'], data.get('LocalizedName', 'Вашем регионе')
 
+    async def current(self, location):
+        data = await self.get("current", location=location)
+        if not data:
+            return None
+        current = data[0]
+        return {
+            "time": parse_local_time(current['LocalObservationDateTime']),
+            "temp": current['Temperature']['Metric']['Value'],
+            "desc": current['WeatherText'],
+            "wind_speed": current['Wind']['Speed']['Metric']['Value'],
+            "is_day": current.get('IsDayTime', True),
+        }
+
+    async def hourly(self, location):
+        data = await self.get("hourly", location=location)
+        if not data:
+            return None
+        return [
+            {
+                "time": parse_local_time(forecast['DateTime']),
+                "temp": forecast['Temperature']['Value'],
+                "desc": forecast['IconPhrase'],
+                "wind_speed": forecast['Wind']['Speed']['Value'],
+                "precip_prob": forecast.get('PrecipitationProbability'),
+                "is_day": forecast.get('IsDaylight', True),
+            }
+            for forecast in data
+        ]
 
-# Асинхронная функция для получения прогноза на 5 дней
-async def fetch_daily_forecast(city):
-    try:
-        location_key = await get_location_key(city)
-        if not location_key:
+    async def daily(self, location):
+        data = await self.get("daily", location=location)
+        if not data or not data.get('DailyForecasts'):
             return None
+        today_forecast = data['DailyForecasts'][0]
+        return {
+            "date": parse_local_time(today_forecast['Date']),
+            "min_temp": today_forecast['Temperature']['Minimum']['Value'],
+            "max_temp": today_forecast['Temperature']['Maximum']['Value'],
+            **{
+                part.lower(): {
+                    "desc": today_forecast[part]['IconPhrase'],
+                    "wind_speed": today_forecast[part]['Wind']['Speed']['Value'],
+                    "precip_prob": today_forecast[part].get('PrecipitationProbability', 0),
+                }
+                for part in ("Day", "Night")
+            },
+        }
+
+
+# Описания погодных кодов WMO (Open-Meteo) в словах, понятных categorize_weather
+WMO_DESCRIPTIONS = {
+    0: "Ясно", 1: "Преимущественно ясно", 2: "Переменная облачность", 3: "Пасмурно",
+    45: "Туман", 48: "Туман с изморозью",
+    51: "Слабая морось", 53: "Морось", 55: "Сильная морось", 56: "Ледяная морось", 57: "Ледяная морось",
+    61: "Небольшой дождь", 63: "Дождь", 65: "Сильный дождь", 66: "Ледяной дождь", 67: "Ледяной дождь",
+    71: "Небольшой снег", 73: "Снег", 75: "Сильный снег", 77: "Снежные зерна",
+    80: "Небольшой ливень", 81: "Ливень", 82: "Сильный ливень", 85: "Снегопад", 86: "Сильный снегопад",
+    95: "Гроза", 96: "Гроза с градом", 99: "Гроза с сильным градом",
+}
+
+
+class OpenMeteoProvider(WeatherProvider):
+    """
+    Open-Meteo: бесплатный API без ключа, локация — пара координат
+    """
+    name = "openmeteo"
 
-        url = f'http://dataservice.accuweather.com/forecasts/v1/daily/5day/{location_key}?apikey={ACCUWEATHER_API_KEY}&language=ru&details=true&metric=true'
-        async with session.get(url) as response:
-            if response.status == 200:
-                data = await response.json()
-                if data and 'DailyForecasts' in data:
-                    return data
-                else:
-                    logger.warning(f"Нет данных о дневном прогнозе для {city}")
-                    return None
-            else:
-                logger.warning(f"Ошибка получения дневного прогноза для {city}: {response.status}")
-                return None
-    except Exception as e:
-        logger.error(f"Ошибка запроса дневного прогноза: {e}")
-        return None
+    SEARCH_URL = "https://geocoding-api.open-meteo.com/v1/search?name={query}&count=1&language=ru"
+    FORECAST_URL = "https://api.open-meteo.com/v1/forecast?latitude={lat}&longitude={lon}&timezone=auto&{params}"
+    HOURLY_FIELDS = "temperature_2m,weather_code,wind_speed_10m,precipitation_probability,is_day"
+
+    async def get(self, url):
+        status, data = await api_get(url)
+        if status != 200:
+            raise ProviderError(f"Open-Meteo: ошибка запроса: {status}")
+        return data
 
+    async def forecast(self, location, params):
+        lat, lon = location
+        return await self.get(self.FORECAST_URL.format(lat=lat, lon=lon, params=params))
 
-# Асинхронная функция для получения информации о локации по координатам
-async def get_location_by_coordinates(lat, lon):
+    async def search(self, city):
+        data = await self.get(self.SEARCH_URL.format(query=city))
+        if not data or not data.get('results'):
+            return None
+        return data['results'][0]['latitude'], data['results'][0]['longitude']
+
+    async def geoposition(self, lat, lon):
+        # Обратного геокодирования у Open-Meteo нет: название места неизвестно
+        return (lat, lon), "Вашем регионе"
+
+    def hours(self, data):
+        hourly = data['hourly']
+        return [
+            {
+                "time": parse_local_time(hourly['time'][i]),
+                "temp": hourly['temperature_2m'][i],
+                "desc": WMO_DESCRIPTIONS.get(hourly['weather_code'][i], "Неизвестно"),
+                "wind_speed": hourly['wind_speed_10m'][i],
+                "precip_prob": hourly['precipitation_probability'][i],
+                "is_day": bool(hourly['is_day'][i]),
+            }
+            for i in range(len(hourly['time']))
+        ]
+
+    # Параметры запроса прогноза для каждого вида данных
+    PARAMS = {
+        "current": "current=temperature_2m,weather_code,wind_speed_10m,is_day",
+        # Как у AccuWeather: 12 часов начиная со следующего
+        "hourly": f"hourly={HOURLY_FIELDS}&forecast_hours=13",
+        "daily": f"hourly={HOURLY_FIELDS}&daily=temperature_2m_max,temperature_2m_min&forecast_days=1",
+    }
+
+    def parse_current(self, data):
+        current = data['current']
+        return {
+            "time": parse_local_time(current['time']),
+            "temp": current['temperature_2m'],
+            "desc": WMO_DESCRIPTIONS.get(current['weather_code'], "Неизвестно"),
+            "wind_speed": current['wind_speed_10m'],
+            "is_day": bool(current['is_day']),
+        }
+
+    def parse_hourly(self, data):
+        return self.hours(data)[1:]
+
+    def parse_daily(self, data):
+        # Дневной и ночной прогноз собираем из часов суток: самая частая погода, максимум ветра и осадков
+        parts = {}
+        for is_day, part in ((True, "day"), (False, "night")):
+            hours = [hour for hour in self.hours(data) if hour["is_day"] == is_day]
+            descs = [hour["desc"] for hour in hours]
+            parts[part] = {
+                "desc": max(set(descs), key=descs.count) if descs else "Неизвестно",
+                "wind_speed": max((hour["wind_speed"] for hour in hours), default=0),
+                "precip_prob": max((hour["precip_prob"] or 0 for hour in hours), default=0),
+            }
+        return {
+            "date": parse_local_time(data['daily']['time'][0]),
+            "min_temp": data['daily']['temperature_2m_min'][0],
+            "max_temp": data['daily']['temperature_2m_max'][0],
+            **parts,
+        }
+
+    async def collect(self, kinds, location):
+        """
+        Параметры текущей погоды не пересекаются с почасовыми, поэтому она едет в одном
+        запросе с первым из прогнозов. Часовой и дневной прогнозы по-разному задают
+        почасовой диапазон и запрашиваются отдельно
+        """
+        groups = [[kind] for kind in kinds if kind != "current"] or [[]]
+        if "current" in kinds:
+            groups[0].append("current")
+        responses = await asyncio.gather(*(
+            self.forecast(location, "&".join(self.PARAMS[kind] for kind in group)) for group in groups
+        ))
+
+        found = {}
+        for group, data in zip(groups, responses):
+            if data:
+                for kind in group:
+                    found[kind] = getattr(self, f"parse_{kind}")(data)
+        return found
+
+    async def current(self, location):
+        return (await self.collect(["current"], location)).get("current")
+
+    async def hourly(self, location):
+        return (await self.collect(["hourly"], location)).get("hourly")
+
+    async def daily(self, location):
+        return (await self.collect(["daily"], location)).get("daily")
+
+
+# Запасные поставщики, которые можно включить через WEATHER_SECONDARY_PROVIDER
+SECONDARY_PROVIDERS = {"openmeteo": OpenMeteoProvider}
+
+# Сколько последних задержек основного поставщика учитывать и сколько нужно для оценки перцентиля
+HEDGE_WINDOW = 200
+HEDGE_MIN_SAMPLES = 20
+
+
+async def call_provider(provider, method, *args):
+    """
+    Вызывает метод поставщика. Ошибка пишется в лог и пробрасывается: роутер отличает ее
+    от пустого ответа («не найдено»)
+    """
     try:
-        url = f'http://dataservice.accuweather.com/locations/v1/cities/geoposition/search?apikey={ACCUWEATHER_API_KEY}&q={lat},{lon}&language=ru'
-        async with session.get(url) as response:
-            if response.status == 200:
-                data = await response.json()
-                if data and 'Key' in data:
-                    location_key = data['Key']
-                    city_name = data.get('LocalizedName', 'Вашем регионе')
-                    return location_key, city_name
-                else:
-                    logger.warning(f"Не удалось получить информацию о локации для координат {lat}, {lon}")
-                    return None, None
-            else:
-                logger.warning(f"Ошибка получения информации о локации: {response.status}")
-                return None, None
+        return await getattr(provider, method)(*args)
     except Exception as e:
-        logger.error(f"Ошибка запроса информации о локации: {e}")
-        return None, None
+        logger.error(f"Ошибка запроса к {provider.name} ({method}): {e}")
+        raise
 
 
-# Асинхронная функция для получения погоды по координатам
-async def fetch_weather_by_coordinates(lat, lon):
-    try:
-        location_key, city_name = await get_location_by_coordinates(lat, lon)
-        if not location_key:
-            return None
+class WeatherRouter:
+    """
+    Направляет запросы основному поставщику. Если он не ответил за HEDGE_PERCENTILE-й
+    перцентиль своих недавних задержек или ответил ошибкой, параллельно спрашивает
+    запасного и возвращает первый полученный ответ. Пустой ответ основного
+    поставщика («город не найден») окончателен и подстраховки не требует
+    """
 
-        url = f'http://dataservice.accuweather.com/currentconditions/v1/{location_key}?apikey={ACCUWEATHER_API_KEY}&language=ru&details=true'
-        async with session.get(url) as response:
-            if response.status == 200:
-                data = await response.json()
-                if data and len(data) > 0:
-                    current = data[0]
-                    description = current.get('WeatherText', '')
-                    temp = current.get('Temperature', {}).get('Metric', {}).get('Value', 0)
-                    wind_speed = current.get('Wind', {}).get('Speed', {}).get('Metric', {}).get('Value', 0)
-
-                    return (
-                        f"🌍 Погода в {city_name}:\n"
-                        f"🌡 Температура: {temp}°C\n"
-                        f"💨 Ветер: {wind_speed} км/ч\n"
-                        f"☁ {description}\n"
-                        f"{generate_weather_description(description, wind_speed, temp)}"
-                    )
-                else:
-                    logger.warning(f"Не удалось получить текущую погоду для координат {lat}, {lon}")
-                    return None
-            else:
-                logger.warning(f"Ошибка получения текущей погоды: {response.status}")
+    def __init__(self, primary, secondary=None):
+        self.primary = primary
+        self.secondary = secondary
+        self.latencies = {}  # {метод: deque(задержки основного поставщика)}
+        self.stats = {"requests": 0, "hedged": 0, "fallbacks": 0, "secondary_wins": 0}
+
+    def hedge_delay(self, method):
+        latencies = self.latencies.get(method, ())
+        if len(latencies) < HEDGE_MIN_SAMPLES:
+            return HEDGE_INITIAL_DELAY
+        return max(HEDGE_MIN_DELAY, percentile(latencies, HEDGE_PERCENTILE))
+
+    async def call_primary(self, waits, started, method, *args):
+        # У запроса своя задача (см. request), поэтому список ожиданий не смешивается с чужими
+        slot_waits.set(waits)
+        loop = asyncio.get_running_loop()
+        try:
+            return await call_provider(self.primary, method, *args)
+        finally:
+            # Очередь за слотом в upstream_lanes — наша задержка, а не поставщика
+            latency = loop.time() - started - covered_time(waits, loop.time())
+            self.latencies.setdefault(method, deque(maxlen=HEDGE_WINDOW)).append(latency)
+
+    async def wait_primary(self, primary, waits, started, method):
+        """
+        Ждет основного поставщика, пока его собственное время (без очереди за слотом)
+        не превысит порог подстраховки. Возвращает True, если он успел ответить
+        """
+        loop = asyncio.get_running_loop()
+        delay = self.hedge_delay(method)
+        while True:
+            done, _ = await asyncio.wait([primary], timeout=delay)
+            if done:
+                return True
+            # Пока основной стоит в очереди, запасной встал бы в ту же очередь
+            delay = self.hedge_delay(method) - (loop.time() - started - covered_time(waits, loop.time()))
+            if delay <= 0:
+                return False
+
+    async def request(self, method, *args):
+        """
+        Вызывает метод поставщика ("locate", "fetch", "fetch_many", "fetch_at") с подстраховкой
+        """
+        self.stats["requests"] += 1
+        # Основной запрос не отменяется, даже если победил запасной: его задержка нужна для статистики
+        waits = []
+        started = asyncio.get_running_loop().time()
+        primary = asyncio.ensure_future(self.call_primary(waits, started, method, *args))
+        primary.add_done_callback(lambda task: task.cancelled() or task.exception())
+        if not self.secondary:
+            await asyncio.wait([primary])
+            return None if primary.exception() else primary.result()
+
+        if current_lane.get() == "background":
+            # Фоновые запросы не подстраховываются: они ждут в очереди, и копия удвоила бы
+            # нагрузку в пике. Запасной спрашиваем, только если основной ответил ошибкой
+            await asyncio.wait([primary])
+            if not primary.exception():
+                return primary.result()
+            self.stats["fallbacks"] += 1
+            try:
+                result = await call_provider(self.secondary, method, *args)
+            except Exception:
                 return None
-    except Exception as e:
-        logger.error(f"Ошибка запроса погоды по координатам: {e}")
+            if result is not None:
+                self.stats["secondary_wins"] += 1
+            return result
+
+        done = await self.wait_primary(primary, waits, started, method)
+        if done and not primary.exception():
+            return primary.result()
+
+        self.stats["hedged"] += 1
+        secondary = asyncio.ensure_future(call_provider(self.secondary, method, *args))
+        pending = {secondary} if done else {primary, secondary}
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception():
+                    continue
+                if task is primary:
+                    secondary.cancel()
+                    return task.result()
+                # Пустой ответ запасного не перебивает основного, который еще может ответить
+                if task.result() is not None or primary.done():
+                    if task.result() is not None:
+                        self.stats["secondary_wins"] += 1
+                    return task.result()
+        return None
+
+    async def request_from(self, name, method, *args):
+        """
+        Вызывает метод конкретного поставщика без подстраховки: локации одного
+        поставщика (например, ключ AccuWeather) другому не подходят
+        """
+        for provider in (self.primary, self.secondary):
+            if provider and provider.name == name:
+                try:
+                    return await call_provider(provider, method, *args)
+                except Exception:
+                    return None
         return None
 
 
-# Функция для генерации описания погоды на основе данных
-def generate_weather_description(desc, wind_speed, temp):
+def build_weather_router():
+    secondary = None
+    if WEATHER_SECONDARY_PROVIDER:
+        if WEATHER_SECONDARY_PROVIDER in SECONDARY_PROVIDERS:
+            secondary = SECONDARY_PROVIDERS[WEATHER_SECONDARY_PROVIDER]()
+        else:
+            logger.warning(f"Неизвестный запасной поставщик погоды: {WEATHER_SECONDARY_PROVIDER}")
+    return WeatherRouter(AccuWeatherProvider(ACCUWEATHER_API_KEY), secondary)
+
+
+weather_router = build_weather_router()
+
+
+# Проверка существования города: возвращает локацию у ответившего поставщика или None
+async def find_city(city):
+    return await weather_router.request("locate", city)
+
+
+# Названия видов данных для логов
+WEATHER_KINDS = {
+    "current": "текущей погоды",
+    "hourly": "часового прогноза",
+    "daily": "дневного прогноза",
+}
+
+# Запросы, которые выполняются прямо сейчас: одновременные потребители ждут один и тот же ответ
+inflight_requests = {}  # {(вид данных, город): asyncio.Task с ответом {вид: данные}}
+
+
+async def request_weather(city, kinds):
+    provider, found = await weather_router.request("fetch_many", kinds, city) or (None, {})
+    for kind in kinds:
+        if kind in found:
+            store_cached_response(kind, city, found[kind], provider)
+        else:
+            logger.warning(f"Нет данных {WEATHER_KINDS[kind]} для {city}")
+    return found
+
+
+def plan_weather_request(city, needs):
     """
-    Генерирует описание погоды в стиле Нами из One Piece с прямым обращением к пользователю.
+    Делит нужные потребителю виды данных на уже лежащие в кэше и недостающие
+    """
+    cached, missing = {}, []
+    for kind in needs:
+        data = get_cached_response(kind, city)
+        if data:
+            cached[kind] = data
+        elif kind not in missing:
+            missing.append(kind)
+    return cached, missing
 
-    Параметры:
-    desc (str): Общее описание погоды (ясно, облачно, дождь и т.д.)
-    wind_speed (float): Скорость ветра в м/с
-    temp (float): Температура в градусах Цельсия
 
-    Возвращает:
-    str: Описание погоды в стиле Нами с обращением к пользователю
+async def fetch_weather_data(city, needs):
+    """
+    Возвращает {вид: данные} для видов, которые нужны потребителю. Актуальное берется
+    из кэша, уже запрошенное другими — из идущих запросов, а остальное запрашивается
+    у поставщика одним планом (см. WeatherProvider.collect)
     """
+    results, missing = plan_weather_request(city, needs)
+    waiting = {kind: inflight_requests[(kind, city)] for kind in missing if (kind, city) in inflight_requests}
+    to_request = tuple(kind for kind in missing if kind not in waiting)
+    if to_request:
+        task = asyncio.ensure_future(request_weather(city, to_request))
+        for kind in to_request:
+            key = (kind, city)
+            inflight_requests[key] = task
+            task.add_done_callback(lambda _, key=key: inflight_requests.pop(key, None))
+            waiting[kind] = task
+
+    for kind, task in waiting.items():
+        # Отмена одного потребителя не должна отменять общий запрос
+        data = (await asyncio.shield(task)).get(kind)
+        if data:
+            results[kind] = data
+    return results
+
+
+async def fetch_weather(city, kind):
+    """
+    Возвращает данные одного вида из кэша, из уже идущего запроса или новым запросом
+    """
+    return (await fetch_weather_data(city, [kind])).get(kind)
+
+
+def has_fresh_data(city, kind):
+    return get_cached_response(kind, city) is not None
+
+
+# Асинхронная функция для получения текущей погоды
+async def fetch_current_weather(city):
+    return await fetch_weather(city, "current")
+
+
+# Асинхронная функция для получения прогноза на 12 часов
+async def fetch_hourly_forecast(city):
+    return await fetch_weather(city, "hourly")
 
+
+# Асинхронная функция для получения прогноза на сегодня
+async def fetch_daily_forecast(city):
+    return await fetch_weather(city, "daily")
+
+
+# Текст текущей погоды по координатам
+def format_location_weather(place, current):
+    return (
+        f"🌍 Погода в {place}:\n"
+        f"🌡 Температура: {current['temp']}°C\n"
+        f"💨 Ветер: {current['wind_speed']} км/ч\n"
+        f"☁ {current['desc']}\n"
+        f"{generate_weather_description(current['desc'], current['wind_speed'], current['temp'])}"
+    )
+
+
+# Фразы Нами собираются один раз при первом использовании
+@functools.lru_cache(maxsize=None)
+def get_nami_phrases():
     # Описания для разных погодных условий
     descriptions = {
         "ясно": [
@@ -360,6 +1585,32 @@ def generate_weather_description(desc, wind_speed, temp):
         ]
     }
 
+    return {
+        "descriptions": descriptions,
+        "wind_comments": wind_comments,
+        "temp_comments": temp_comments,
+    }
+
+
+# Функция для генерации описания погоды на основе данных
+def generate_weather_description(desc, wind_speed, temp):
+    """
+    Генерирует описание погоды в стиле Нами из One Piece с прямым обращением к пользователю.
+
+    Параметры:
+    desc (str): Общее описание погоды (ясно, облачно, дождь и т.д.)
+    wind_speed (float): Скорость ветра в м/с
+    temp (float): Температура в градусах Цельсия
+
+    Возвращает:
+    str: Описание погоды в стиле Нами с обращением к пользователю
+    """
+
+    phrases = get_nami_phrases()
+    descriptions = phrases["descriptions"]
+    wind_comments = phrases["wind_comments"]
+    temp_comments = phrases["temp_comments"]
+
     # Определение категории ветра
     if wind_speed < 2:
         wind_category = "слабый"
@@ -433,99 +1684,190 @@ def generate_weather_description(desc, wind_speed, temp):
     return full_description
 
 
-# Текущая погода
-@dp.message_handler(commands=['Pogoda_now'])
-async def get_weather_now(message: Message):
-    await message.answer(f"{get_moji()} Введите название города:")
-    await WeatherForm.waiting_for_city_now.set()
+# Форматирование ответов (общие для команд, текстовых и inline-запросов)
+def format_current_weather(city, data):
+    temp = data["temp"]
+    desc = data["desc"]
+    wind_speed = data["wind_speed"]
 
+    # Местное время наблюдения
+    local_time = data["time"].strftime('%H:%M')
 
-@dp.message_handler(state=WeatherForm.waiting_for_city_now)
-async def receive_weather_now(message: Message, state: FSMContext):
-    city = message.text.strip().lower()
-    data = await fetch_current_weather(city)
+    is_day = data["is_day"]
+    emoji = "🏙️" if is_day else "🌃"
+
+    weather_text = (
+        f"{emoji} **{city.capitalize()}**\n"
+        f"🕒 *Local Time:* {local_time}\n"
+        f"---------------------------------\n"
+        f"🌡 *Temperature:* {temp}°C\n"
+        f"🌫 *Condition:* {desc}\n"
+        f"💨 *Wind:* {wind_speed} км/ч\n"
+        f"{generate_weather_description(desc, wind_speed, temp)}"
+    )
+    return weather_text
+
+
+def format_hourly_forecast(city, data):
+    forecast_text = (
+        f"🌍 **{city.capitalize()}** - 12-Hour Forecast\n"
+        f"---------------------------------\n"
+    )
+
+    # Выбираем каждые 3 часа прогноза (индексы 0, 3, 6, 9)
+    selected_forecasts = [data[i] for i in range(0, min(12, len(data)), 3)]
+
+    for forecast in selected_forecasts:
+        dt_local = forecast["time"]
+        temp = forecast["temp"]
+        desc = forecast["desc"]
+        wind_speed = forecast["wind_speed"]
+        is_day = forecast["is_day"]
+        emoji = "☀️" if is_day else "🌙"
+
+        forecast_text += (
+            f"{emoji} **{dt_local.strftime('%d-%m %H:%M')}**\n"
+            f"🌡 *Temp:* {temp}°C | 🌫 *Cond:* {desc} | 💨 *Wind:* {wind_speed} км/ч\n"
+            f"---------------------------------\n"
+        )
+
+    return forecast_text
+
+
+def format_daily_forecast(city, data):
+    # Получаем дату
+    date = data["date"].strftime('%d.%m.%Y')
+
+    # Температуры
+    min_temp = data["min_temp"]
+    max_temp = data["max_temp"]
+    avg_temp = (min_temp + max_temp) / 2
+
+    # Описание дня и ночи
+    day_desc = data["day"]["desc"]
+    night_desc = data["night"]["desc"]
+
+    # Ветер (берем максимальный)
+    day_wind = data["day"]["wind_speed"]
+    night_wind = data["night"]["wind_speed"]
+    max_wind = max(day_wind, night_wind)
+
+    # Вероятность осадков
+    day_precip_prob = data["day"]["precip_prob"]
+    night_precip_prob = data["night"]["precip_prob"]
+
+    weather_text = (
+        f"🌍 **{city.capitalize()}** - Прогноз на {date}\n"
+        f"---------------------------------\n"
+        f"🌡 *Температура:* от {min_temp}°C до {max_temp}°C (в среднем {avg_temp:.1f}°C)\n"
+        f"☀️ *Днем:* {day_desc} (вероятность осадков: {day_precip_prob}%)\n"
+        f"🌙 *Ночью:* {night_desc} (вероятность осадков: {night_precip_prob}%)\n"
+        f"💨 *Максимальный ветер:* {max_wind} км/ч\n"
+        f"{generate_weather_description(day_desc, max_wind, max_temp)}"
+    )
+    return weather_text
+
+
+# Недавние города пользователей для кнопок (ограниченный LRU вместо состояний FSM)
+recent_cities = OrderedDict()  # {user_id: deque([город, ...])}
+
+
+def remember_city(user_id, city):
+    cities = recent_cities.pop(user_id, None) or deque(maxlen=RECENT_CITIES_PER_USER)
+    if city in cities:
+        cities.remove(city)
+    cities.appendleft(city)
+    recent_cities[user_id] = cities
+
+    # Забываем самых давних пользователей
+    while len(recent_cities) > RECENT_CITIES_USERS_LIMIT:
+        recent_cities.popitem(last=False)
+
+
+def get_quick_cities(user_id):
+    """
+    Города для кнопок: сначала подписки, затем недавние запросы
+    """
+    cities = list(user_subscriptions.get(user_id, []))
+    for city in recent_cities.get(user_id, ()):
+        if city not in cities:
+            cities.append(city)
+    return cities[:QUICK_CITIES_LIMIT]
+
+
+def build_city_keyboard(action, cities):
+    keyboard = InlineKeyboardMarkup(row_width=2)
+    keyboard.add(*[
+        InlineKeyboardButton(city.capitalize(), callback_data=f"{action}:{city}")
+        for city in cities
+        if len(f"{action}:{city}".encode("utf-8")) <= 64  # ограничение Telegram на callback_data
+    ])
+    return keyboard
+
+
+# Запрос и форматирование для каждой погодной команды
+WEATHER_ACTIONS = {
+    "now": (fetch_current_weather, format_current_weather),
+    "3h": (fetch_hourly_forecast, format_hourly_forecast),
+    "day": (fetch_daily_forecast, format_daily_forecast),
+}
+
+
+async def get_weather_text(action, city):
+    """
+    Возвращает (текст ответа, получены ли данные о погоде)
+    """
+    fetch, formatter = WEATHER_ACTIONS[action]
+    data = await fetch(city)
+    if not data:
+        return "❌ Ошибка! Город не найден.", False
+
+    try:
+        return formatter(city, data), True
+    except (KeyError, IndexError) as e:
+        logger.error(f"Ошибка получения данных из ответа API: {e}")
+        return "❌ Произошла ошибка при обработке данных о погоде.", False
+
+
+async def ask_city(message: Message, action):
+    """
+    Отвечает сразу, если город указан после команды, иначе предлагает кнопки с городами
+    """
+    user_id = str(message.from_user.id)
+    city = message.get_args().strip().lower()
+    if city:
+        text, found = await get_weather_text(action, city)
+        # На кнопки попадают только города, для которых нашлась погода
+        if found:
+            remember_city(user_id, city)
+        await message.answer(text, parse_mode=ParseMode.MARKDOWN)
+        return
+
+    await ensure_subscriptions_loaded()
+    cities = get_quick_cities(user_id)
+    if not cities:
+        await message.answer(
+            f"{get_moji()} Укажите город после команды, например: /{message.get_command(pure=True)} Ташкент"
+        )
+        return
 
-    if data:
-        try:
-            temp = data['Temperature']['Metric']['Value']
-            desc = data['WeatherText']
-            wind_speed = data['Wind']['Speed']['Metric']['Value']
-
-            # Получаем местное время из временной метки наблюдения
-            observation_time = datetime.strptime(data['LocalObservationDateTime'], "%Y-%m-%dT%H:%M:%S%z")
-            local_time = observation_time.strftime('%H:%M')
-
-            is_day = data.get('IsDayTime', True)
-            emoji = "🏙️" if is_day else "🌃"
-
-            weather_text = (
-                f"{emoji} **{city.capitalize()}**\n"
-                f"🕒 *Local Time:* {local_time}\n"
-                f"---------------------------------\n"
-                f"🌡 *Temperature:* {temp}°C\n"
-                f"🌫 *Condition:* {desc}\n"
-                f"💨 *Wind:* {wind_speed} км/ч\n"
-                f"{generate_weather_description(desc, wind_speed, temp)}"
-            )
+    await message.answer(f"{get_moji()} Выберите город:", reply_markup=build_city_keyboard(action, cities))
 
-            await message.answer(weather_text, parse_mode=ParseMode.MARKDOWN)
-        except KeyError as e:
-            logger.error(f"Ошибка получения данных из ответа API: {e}")
-            await message.answer("❌ Произошла ошибка при обработке данных о погоде.")
-    else:
-        await message.answer("❌ Ошибка! Город не найден.")
 
-    await state.finish()
+# Текущая погода
+@dp.message_handler(commands=['Pogoda_now'])
+async def get_weather_now(message: Message):
+    await ask_city(message, "now")
 
 
 # Прогноз каждые 3 часа (на 12 часов)
 @dp.message_handler(commands=['pogoda_every_3h'])
 async def get_weather_3h(message: Message):
-    await message.answer(f"{get_moji()} Введите название города:")
-    await WeatherForm.waiting_for_city_forecast.set()
-
-
-@dp.message_handler(state=WeatherForm.waiting_for_city_forecast)
-async def receive_weather_3h(message: Message, state: FSMContext):
-    city = message.text.strip().lower()
-    data = await fetch_hourly_forecast(city)
-
-    if data:
-        try:
-            forecast_text = (
-                f"🌍 **{city.capitalize()}** - 12-Hour Forecast\n"
-                f"---------------------------------\n"
-            )
-
-            # Выбираем каждые 3 часа прогноза (индексы 0, 3, 6, 9)
-            selected_forecasts = [data[i] for i in range(0, min(12, len(data)), 3)]
-
-            for forecast in selected_forecasts:
-                dt_local = datetime.strptime(forecast['DateTime'], "%Y-%m-%dT%H:%M:%S%z")
-                temp = forecast['Temperature']['Value']
-                desc = forecast['IconPhrase']
-                wind_speed = forecast['Wind']['Speed']['Value']
-                is_day = forecast.get('IsDaylight', True)
-                emoji = "☀️" if is_day else "🌙"
-
-                forecast_text += (
-                    f"{emoji} **{dt_local.strftime('%d-%m %H:%M')}**\n"
-                    f"🌡 *Temp:* {temp}°C | 🌫 *Cond:* {desc} | 💨 *Wind:* {wind_speed} км/ч\n"
-                    f"---------------------------------\n"
-                )
-
-            await message.answer(forecast_text, parse_mode=ParseMode.MARKDOWN)
-        except KeyError as e:
-            logger.error(f"Ошибка получения данных из ответа API: {e}")
-            await message.answer("❌ Произошла ошибка при обработке данных о погоде.")
-    else:
-        await message.answer("❌ Ошибка! Город не найден.")
-
-    await state.finish()
+    await ask_city(message, "3h")
 
 
 def get_moji():
-    hour = datetime.now().hour
+    hour = clock.now().hour
     emoji_map = {
         range(4, 7): "🌆",
         range(7, 17): "🏙️",
@@ -543,62 +1885,22 @@ def get_moji():
 # Прогноз на день
 @dp.message_handler(commands=['Pogoda_day'])
 async def get_weather_day(message: Message):
-    await message.answer(f"{get_moji()} Введите название города:")
-    await WeatherForm.waiting_for_city_day.set()
-
-
-@dp.message_handler(state=WeatherForm.waiting_for_city_day)
-async def receive_weather_day(message: Message, state: FSMContext):
-    city = message.text.strip().lower()
-    data = await fetch_daily_forecast(city)
+    await ask_city(message, "day")
 
-    if data:
-        try:
-            # Берем только прогноз на сегодня
-            today_forecast = data['DailyForecasts'][0]
-
-            # Получаем дату
-            date = datetime.strptime(today_forecast['Date'], "%Y-%m-%dT%H:%M:%S%z").strftime('%d.%m.%Y')
-
-            # Температуры
-            min_temp = today_forecast['Temperature']['Minimum']['Value']
-            max_temp = today_forecast['Temperature']['Maximum']['Value']
-            avg_temp = (min_temp + max_temp) / 2
-
-            # Описание дня и ночи
-            day_desc = today_forecast['Day']['IconPhrase']
-            night_desc = today_forecast['Night']['IconPhrase']
-
-            # Ветер (берем максимальный)
-            day_wind = today_forecast['Day']['Wind']['Speed']['Value']
-            night_wind = today_forecast['Night']['Wind']['Speed']['Value']
-            max_wind = max(day_wind, night_wind)
-
-            # Вероятность осадков
-            day_precip_prob = today_forecast['Day'].get('PrecipitationProbability', 0)
-            night_precip_prob = today_forecast['Night'].get('PrecipitationProbability', 0)
-
-            weather_text = (
-                f"🌍 **{city.capitalize()}** - Прогноз на {date}\n"
-                f"---------------------------------\n"
-                f"🌡 *Температура:* от {min_temp}°C до {max_temp}°C (в среднем {avg_temp:.1f}°C)\n"
-                f"☀️ *Днем:* {day_desc} (вероятность осадков: {day_precip_prob}%)\n"
-                f"🌙 *Ночью:* {night_desc} (вероятность осадков: {night_precip_prob}%)\n"
-                f"💨 *Максимальный ветер:* {max_wind} км/ч\n"
-                f"{generate_weather_description(day_desc, max_wind, max_temp)}"
-            )
 
-            await message.answer(weather_text, parse_mode=ParseMode.MARKDOWN)
-        except KeyError as e:
-            logger.error(f"Ошибка получения данных из ответа API: {e}")
-            await message.answer("❌ Произошла ошибка при обработке данных о погоде.")
-    else:
-        await message.answer("❌ Ошибка! Город не найден.")
+@dp.callback_query_handler(lambda call: call.data.split(":", 1)[0] in WEATHER_ACTIONS)
+async def weather_button(call: types.CallbackQuery):
+    action, city = call.data.split(":", 1)
+    await call.answer()
+    text, found = await get_weather_text(action, city)
+    if found:
+        remember_city(str(call.from_user.id), city)
+    await call.message.edit_text(text, parse_mode=ParseMode.MARKDOWN)
 
-    await state.finish()
 
 @dp.message_handler(commands=['subscribe'])
 async def subscribe(message: types.Message):
+    await ensure_subscriptions_loaded()
     user_id = str(message.from_user.id)  # JSON не поддерживает int в качестве ключей
     if user_id not in user_subscriptions:
         user_subscriptions[user_id] = []  # Создаем список городов для пользователя
@@ -610,55 +1912,89 @@ async def subscribe(message: types.Message):
 
 @dp.message_handler(state=WeatherForm.waiting_for_subscribe_city)
 async def set_city(message: types.Message, state: FSMContext):
+    await ensure_subscriptions_loaded()
     user_id = str(message.from_user.id)
-    cities = [c.strip().lower() for c in message.text.split(",")]
 
-    for city in cities:
-        # Проверяем существование города через получение location key
-        location_key = await get_location_key(city)
-        if location_key:
-            if city not in user_subscriptions[user_id]:
-                user_subscriptions[user_id].append(city)
-                await message.answer(f"✅ Город {city.capitalize()} добавлен в подписку!")
-                save_subscriptions(user_subscriptions)
-            else:
-                await message.answer(f"⚠️ {city.capitalize()} уже отслеживается.")
+    # Убираем пустые и повторяющиеся названия, сохраняя порядок
+    cities = list(dict.fromkeys(c.strip().lower() for c in message.text.split(",") if c.strip()))
+    skipped = cities[MAX_CITIES_PER_REQUEST:]
+    cities = cities[:MAX_CITIES_PER_REQUEST]
+
+    # Проверяем существование всех городов одновременно
+    locations = await asyncio.gather(*(find_city(city) for city in cities))
+
+    subscribed = user_subscriptions.setdefault(user_id, [])
+    added, already_tracked, not_found = [], [], []
+    for city, location in zip(cities, locations):
+        if not location:
+            not_found.append(city)
+        elif city in subscribed:
+            already_tracked.append(city)
         else:
-            await message.answer(f"❌ Город {city.capitalize()} не найден.")
+            subscribed.append(city)
+            added.append(city)
+
+    # Сохраняем подписки один раз на всё сообщение
+    if added:
+        save_subscriptions(user_subscriptions)
+
+    lines = []
+    if added:
+        lines.append("✅ Добавлены в подписку: " + ", ".join(c.capitalize() for c in added))
+    if already_tracked:
+        lines.append("⚠️ Уже отслеживаются: " + ", ".join(c.capitalize() for c in already_tracked))
+    if not_found:
+        lines.append("❌ Не найдены: " + ", ".join(c.capitalize() for c in not_found))
+    if skipped:
+        lines.append(
+            f"✂️ За раз можно добавить до {MAX_CITIES_PER_REQUEST} городов, пропущены: "
+            + ", ".join(c.capitalize() for c in skipped)
+        )
+    await message.answer("\n".join(lines) or "❌ Не указано ни одного города.")
 
     await state.finish()
 
 
+def remove_subscription(user_id, city):
+    """
+    Отписывает пользователя от города и возвращает текст ответа
+    """
+    if city not in user_subscriptions.get(user_id, []):
+        return f"❌ Вы не подписаны на {city.capitalize()}."
+
+    user_subscriptions[user_id].remove(city)
+    if not user_subscriptions[user_id]:  # Если список стал пустым — удалить ключ
+        del user_subscriptions[user_id]
+    save_subscriptions(user_subscriptions)
+    return f"✅ Вы отписались от {city.capitalize()}."
+
+
 @dp.message_handler(commands=['unsubscribe'])
 async def unsubscribe_city(message: Message):
+    await ensure_subscriptions_loaded()
     user_id = str(message.from_user.id)
 
     if user_id not in user_subscriptions or not user_subscriptions[user_id]:
         await message.answer("❌ Вы не подписаны ни на один город.")
         return
 
+    city = message.get_args().strip().lower()
+    if city:
+        await message.answer(remove_subscription(user_id, city))
+        return
+
     await message.answer(
-        "📍 Введите название города, от которого хотите отписаться.\n"
-        "Ваши подписки:\n" + "\n".join(c.capitalize() for c in user_subscriptions[user_id])
+        "📍 Выберите город, от которого хотите отписаться:",
+        reply_markup=build_city_keyboard("unsub", user_subscriptions[user_id])
     )
-    await WeatherForm.waiting_for_unsubscribe_city.set()
-
-
-@dp.message_handler(state=WeatherForm.waiting_for_unsubscribe_city)
-async def process_unsubscribe(message: Message, state: FSMContext):
-    user_id = str(message.from_user.id)
-    city = message.text.strip().lower()
 
-    if city in user_subscriptions.get(user_id, []):
-        user_subscriptions[user_id].remove(city)
-        if not user_subscriptions[user_id]:  # Если список стал пустым — удалить ключ
-            del user_subscriptions[user_id]
-        save_subscriptions(user_subscriptions)
-        await message.answer(f"✅ Вы отписались от {city.capitalize()}.")
-    else:
-        await message.answer(f"❌ Вы не подписаны на {city.capitalize()}.")
 
-    await state.finish()
+@dp.callback_query_handler(lambda call: call.data.startswith("unsub:"))
+async def unsubscribe_button(call: types.CallbackQuery):
+    await ensure_subscriptions_loaded()
+    city = call.data.split(":", 1)[1]
+    await call.answer()
+    await call.message.edit_text(remove_subscription(str(call.from_user.id), city))
 
 
 # Категоризация типов погоды для AccuWeather
@@ -682,318 +2018,935 @@ def categorize_weather(desc):
         return desc  # Если не попадает ни в одну категорию
 
 
+# Коды категорий погоды в почасовом ряду города (код 0 — прочие явления)
+WEATHER_CATEGORIES = ("other", "clear", "cloudy", "rain", "snow", "fog")
+WEATHER_CATEGORY_CODES = {category: code for code, category in enumerate(WEATHER_CATEGORIES)}
+# Значение байтовых столбцов для часов без прогноза
+SERIES_MISSING = 255
+# Начало отсчета номеров часов (местное время города без часового пояса)
+SERIES_EPOCH = datetime(1970, 1, 1)
+
+
+def hour_number(dt):
+    """Номер часа от SERIES_EPOCH"""
+    return int((dt - SERIES_EPOCH).total_seconds() // 3600)
+
+
+class CitySeries:
+    """
+    Почасовой прогноз города в кольцевом буфере ревизий.
+
+    Для каждой из последних SERIES_REVISIONS ревизий хранится SERIES_HORIZON_HOURS
+    часов в компактных столбцах array (температура, ветер, вероятность осадков,
+    код категории), индекс — смещение часа от начала ревизии. Размер буфера
+    фиксирован и не зависит от числа подписчиков города
+    """
+
+    def __init__(self, horizon=SERIES_HORIZON_HOURS, revisions=SERIES_REVISIONS):
+        size = horizon * revisions
+        self.horizon = horizon
+        self.revisions = revisions
+        self.temp = array("f", [0.0]) * size
+        self.wind = array("f", [0.0]) * size
+        self.precip = array("B", [SERIES_MISSING]) * size
+        self.category = array("B", [SERIES_MISSING]) * size
+        self.start_hour = array("l", [0]) * revisions  # номер первого часа ревизии
+        self.length = array("H", [0]) * revisions  # сколько часов заполнено
+        self.fetched_at = array("d", [0.0]) * revisions
+        self.latest = -1  # слот последней ревизии
+        self.count = 0  # сколько ревизий записано всего
+
+    def nbytes(self):
+        return sum(
+            column.itemsize * len(column)
+            for column in (self.temp, self.wind, self.precip, self.category, self.start_hour, self.length, self.fetched_at)
+        )
+
+    def slot(self, back=0):
+        """Слот ревизии: 0 — последняя, 1 — предыдущая и т.д.; None, если ее нет"""
+        if back >= min(self.count, self.revisions):
+            return None
+        return (self.latest - back) % self.revisions
+
+    def columns(self, back=0):
+        """
+        Возвращает (номер первого часа, температура, ветер, осадки, категории)
+        ревизии в виде срезов столбцов, или None, если ревизии нет
+        """
+        slot = self.slot(back)
+        if slot is None:
+            return None
+        begin = slot * self.horizon
+        end = begin + self.length[slot]
+        return (
+            self.start_hour[slot], self.temp[begin:end], self.wind[begin:end],
+            self.precip[begin:end], self.category[begin:end],
+        )
+
+    def add_revision(self, forecast_data, fetched_at):
+        """
+        Записывает почасовой прогноз как новую ревизию.
+        Повторный прогноз с теми же значениями новой ревизией не считается
+        """
+        hours = []
+        for forecast in forecast_data:
+            precip = forecast["precip_prob"]
+            hours.append((
+                hour_number(forecast["time"]),
+                forecast["temp"],
+                forecast["wind_speed"],
+                SERIES_MISSING if precip is None else min(int(precip), 100),
+                WEATHER_CATEGORY_CODES.get(categorize_weather(forecast["desc"]), 0),
+            ))
+        if not hours:
+            return False
+        hours.sort()
+
+        start = hours[0][0]
+        length = min(hours[-1][0] - start + 1, self.horizon)
+        temp = array("f", [0.0]) * length
+        wind = array("f", [0.0]) * length
+        precip = array("B", [SERIES_MISSING]) * length
+        category = array("B", [SERIES_MISSING]) * length
+        for hour, hour_temp, hour_wind, hour_precip, hour_category in hours:
+            offset = hour - start
+            if offset < length:
+                temp[offset], wind[offset] = hour_temp, hour_wind
+                precip[offset], category[offset] = hour_precip, hour_category
+
+        latest = self.columns()
+        if latest and latest[0] == start and latest[1:] == (temp, wind, precip, category):
+            return False
+
+        slot = (self.latest + 1) % self.revisions
+        begin = slot * self.horizon
+        self.temp[begin:begin + length] = temp
+        self.wind[begin:begin + length] = wind
+        self.precip[begin:begin + length] = precip
+        self.category[begin:begin + length] = category
+        self.start_hour[slot] = start
+        self.length[slot] = length
+        self.fetched_at[slot] = fetched_at
+        self.latest = slot
+        self.count += 1
+        return True
+
+    # Столбцы, которые сохраняются в снимок как сырые байты
+    STATE_COLUMNS = ("temp", "wind", "precip", "category", "start_hour", "length", "fetched_at")
+
+    def to_state(self):
+        """Ряд в виде простых данных для снимка состояния"""
+        state = {"horizon": self.horizon, "revisions": self.revisions, "latest": self.latest, "count": self.count}
+        for name in self.STATE_COLUMNS:
+            state[name] = base64.b64encode(getattr(self, name).tobytes()).decode("ascii")
+        return state
+
+    @classmethod
+    def from_state(cls, state):
+        series = cls(state["horizon"], state["revisions"])
+        for name in cls.STATE_COLUMNS:
+            column = array(getattr(series, name).typecode)
+            column.frombytes(base64.b64decode(state[name]))
+            if len(column) != len(getattr(series, name)):
+                raise ValueError(f"неверный размер столбца {name}")
+            setattr(series, name, column)
+        series.latest = state["latest"]
+        series.count = state["count"]
+        return series
+
+    def periods(self, back=0):
+        """
+        Разбивает ревизию на периоды одной категории погоды (по сериям одинаковых кодов)
+        со средними температурой и ветром
+        """
+        columns = self.columns(back)
+        if columns is None:
+            return []
+        start, temp, wind, precip, category = columns
+
+        periods = []
+        offset = 0
+        for code, run in itertools.groupby(category):
+            run_length = sum(1 for _ in run)
+            end = offset + run_length
+            if code != SERIES_MISSING:
+                periods.append({
+                    "category": WEATHER_CATEGORIES[code],
+                    "start_time": SERIES_EPOCH + timedelta(hours=start + offset),
+                    "end_time": SERIES_EPOCH + timedelta(hours=start + end - 1),
+                    "avg_temp": sum(temp[offset:end]) / run_length,
+                    "avg_wind": sum(wind[offset:end]) / run_length,
+                    "max_precip": max(precip[offset:end]) if SERIES_MISSING not in precip[offset:end] else None,
+                })
+            offset = end
+        return periods
+
+
+# Почасовые ряды прогноза по городам
+city_series = {}  # {город: CitySeries}
+
+
+@background_lane
+async def fetch_primary_hourly_forecast(city):
+    """
+    Часовой прогноз только от основного поставщика, без подстраховки
+    """
+    provider = weather_router.primary.name
+    data = await weather_router.request_from(provider, "fetch", "hourly", city)
+    if data:
+        store_cached_response("hourly", city, data, provider)
+    return data
+
+
+async def update_city_series(city):
+    """
+    Получает почасовой прогноз города (из кэша, если он свежий) и добавляет его в ряд.
+    Возвращает ряд города или None, если прогноза нет
+    """
+    series = city_series.get(city)
+    forecast_data = await fetch_hourly_forecast(city)
+    # Ряд строится только по основному поставщику: часы и погода у запасного другие,
+    # и ревизия из его ответа дала бы новые id событий для той же непогоды
+    if forecast_data and get_cached_provider("hourly", city) != weather_router.primary.name:
+        forecast_data = await fetch_primary_hourly_forecast(city)
+    if not forecast_data:
+        return series
+
+    # Новый ряд попадает в city_series только с первой записанной ревизией
+    if series is None:
+        series = CitySeries()
+    try:
+        series.add_revision(forecast_data, clock.time())
+    except (KeyError, TypeError, ValueError) as e:
+        logger.error(f"Ошибка разбора почасового прогноза для {city}: {e}")
+    if not series.count:
+        return None
+    city_series[city] = series
+    return series
+
+
+@background_lane
+async def run_monitor_cycle():
+    """
+    Один цикл мониторинга: проверяет прогнозы подписанных городов и отправляет уведомления
+    """
+    monitor_state["last_cycle"] = clock.time()
+    record_traffic("cycle", {"loop": "weather_monitor"})
+
+    # Обрабатываем только города, закрепленные за этим экземпляром
+    city_subscribers = get_city_subscribers()
+    owned_cities = await get_owned_cities(city_subscribers)
+
+    # Города, которых не было у экземпляра в прошлом цикле, могли перейти от другого:
+    # отправленные им события берем из общей базы
+    shared_sent = await get_shared_sent_alerts(owned_cities - set(city_alert_events))
+    new_sent = {}  # {город: {id события: время отправки}}
+
+    # Уведомления копятся за весь цикл: {user_id: [(время события, текст), ...]}
+    user_alerts = {}
+
+    # События городов без подписчиков больше не нужны
+    for city in [city for city in city_alert_events if city not in owned_cities]:
+        del city_alert_events[city]
+
+    for city, user_ids in city_subscribers.items():
+        if city not in owned_cities:
+            continue
+
+        # Уведомления строятся только по почасовому прогнозу
+        series = await update_city_series(city)
+        if not series:
+            continue
+
+        # События считаются один раз на город, подписчикам достаются только еще не отправленные
+        events = get_upcoming_alert_events(city, series, clock.now())
+        sent_at = clock.time()
+        for user_id in user_ids:
+            city_state = last_weather.setdefault(user_id, {}).setdefault(city, {
+                "sent_notifications": {}  # Для отслеживания отправленных уведомлений
+            })
+            sent_notifications = city_state["sent_notifications"]
+            for event_id, shared_at in shared_sent.get(city, {}).items():
+                sent_notifications.setdefault(event_id, shared_at)
+            for event in events:
+                if event["id"] not in sent_notifications:
+                    sent_notifications[event["id"]] = sent_at
+                    new_sent.setdefault(city, {})[event["id"]] = sent_at
+                    user_alerts.setdefault(user_id, []).append((event["time"], event["text"]))
+
+    # Отправляем уведомления одной сводкой на пользователя
+    await share_sent_alerts(new_sent)
+    await deliver_alert_digests(user_alerts)
+
+
 async def weather_monitor():
+    # После перезапуска не повторяем цикл, если он недавно выполнялся
+    elapsed = clock.time() - monitor_state["last_cycle"]
+    if elapsed < WEATHER_MONITOR_INTERVAL:
+        await clock.sleep(WEATHER_MONITOR_INTERVAL - elapsed)
+
     while True:
-        for user_id, cities in user_subscriptions.items():
-            for city in cities:
-                # Получаем данные о текущей погоде и прогноз на ближайшие часы
-                current_data = await fetch_current_weather(city)
-                forecast_data = await fetch_hourly_forecast(city)
-
-                if current_data and forecast_data:
-                    # Инициализируем структуры данных если нужно
-                    if user_id not in last_weather:
-                        last_weather[user_id] = {}
-                    if city not in last_weather[user_id]:
-                        last_weather[user_id][city] = {
-                            "hourly_forecasts": {},  # Для хранения прогнозов по часам
-                            "weather_periods": [],  # Для хранения периодов определенных погодных явлений
-                            "sent_notifications": {}  # Для отслеживания отправленных уведомлений
-                        }
-
-                    # Текущее время
-                    now = datetime.now()
-
-                    # Анализируем прогнозы
-                    forecasts = []
-                    for forecast in forecast_data:
-                        dt_local = datetime.strptime(forecast['DateTime'], "%Y-%m-%dT%H:%M:%S%z")
-                        dt_local = dt_local.replace(tzinfo=None)  # Убираем часовой пояс для сравнения
-
-                        desc = forecast['IconPhrase']
-                        wind_speed = forecast['Wind']['Speed']['Value']
-                        temp = forecast['Temperature']['Value']
-                        category = categorize_weather(desc)
-
-                        forecast_hour = dt_local.replace(minute=0, second=0, microsecond=0)
-                        hour_key = forecast_hour.strftime('%Y%m%d%H')
-
-                        forecast_data = {
-                            "datetime": dt_local,
-                            "hour_key": hour_key,
-                            "desc": desc,
-                            "category": category,
-                            "wind_speed": wind_speed,
-                            "temp": temp
-                        }
-
-                        forecasts.append(forecast_data)
-
-                        # Сохраняем прогноз по часам
-                        last_weather[user_id][city]["hourly_forecasts"][hour_key] = forecast_data
-
-                    # Если у нас достаточно прогнозов, анализируем их для выявления периодов
-                    if forecasts:
-                        await analyze_weather_periods(user_id, city, forecasts, now)
-
-        await asyncio.sleep(7200)  # Проверка раз в 2 часа
-
-
-async def analyze_weather_periods(user_id, city, forecasts, now):
-    """
-    Анализирует прогнозы и выявляет периоды определенных погодных явлений
-    """
-    # Сортируем прогнозы по времени
-    forecasts.sort(key=lambda x: x["datetime"])
-
-    # Находим периоды одинаковой погоды
-    periods = []
-    current_period = None
-
-    for forecast in forecasts:
-        if current_period is None:
-            # Начинаем новый период
-            current_period = {
-                "category": forecast["category"],
-                "start_time": forecast["datetime"],
-                "end_time": forecast["datetime"],
-                "description": forecast["desc"],
-                "forecasts": [forecast]
-            }
-        elif forecast["category"] == current_period["category"]:
-            # Продолжаем текущий период
-            current_period["end_time"] = forecast["datetime"]
-            current_period["forecasts"].append(forecast)
-        else:
-            # Завершаем текущий период и начинаем новый
-            periods.append(current_period)
-            current_period = {
-                "category": forecast["category"],
-                "start_time": forecast["datetime"],
-                "end_time": forecast["datetime"],
-                "description": forecast["desc"],
-                "forecasts": [forecast]
-            }
+        await run_monitor_cycle()
+        await clock.sleep(WEATHER_MONITOR_INTERVAL)  # Проверка раз в 2 часа
+
+
+# События уведомлений по последней ревизии ряда города
+city_alert_events = {}  # {город: (номер ревизии, [событие, ...])}
+
+
+def get_upcoming_alert_events(city, series, now):
+    """
+    Возвращает события уведомлений города, которые наступят в ближайшие 24 часа.
+    События пересчитываются, только когда в ряду появилась новая ревизия прогноза
+    """
+    revision, events = city_alert_events.get(city, (None, []))
+    if revision != series.count:
+        events = check_weather_patterns(city, series.periods())
+        city_alert_events[city] = (series.count, events)
 
-    # Добавляем последний период
-    if current_period:
-        periods.append(current_period)
+    # Уведомляем только о будущих изменениях в пределах 24 часов
+    return [event for event in events if 0 <= (event["time"] - now).total_seconds() / 3600 <= 24]
 
-    # Обновляем периоды погоды
-    last_weather[user_id][city]["weather_periods"] = periods
 
-    # Проверяем паттерны изменения погоды
-    await check_weather_patterns(user_id, city, periods, now)
+def alert_event(kind, city, period, text):
+    """
+    Событие уведомления со стабильным идентификатором: одно и то же явление
+    в следующих ревизиях прогноза получает тот же id и повторно не отправляется
+    """
+    return {
+        "id": f"{kind}:{city}:{period['start_time'].strftime('%Y%m%d%H')}",
+        "time": period["start_time"],
+        "text": text,
+    }
 
 
-async def check_weather_patterns(user_id, city, periods, now):
+def check_weather_patterns(city, periods):
     """
-    Проверяет паттерны изменения погоды и отправляет содержательные уведомления
+    Проверяет паттерны изменения погоды между периодами и возвращает
+    содержательные события уведомлений
     """
     if len(periods) < 2:
-        return  # Недостаточно периодов для анализа
+        return []  # Недостаточно периодов для анализа
 
-    alerts = []
+    events = []
 
     for i in range(len(periods) - 1):
         current_period = periods[i]
         next_period = periods[i + 1]
 
-        # Формируем уникальный ключ для этой пары периодов
-        period_pair_key = f"{current_period['start_time'].strftime('%Y%m%d%H')}_to_{next_period['start_time'].strftime('%Y%m%d%H')}"
+        # 1. Прекращение осадков на короткое время
+        if (current_period["category"] in ["rain", "snow"] and
+                next_period["category"] not in ["rain", "snow"]):
+
+            # Если есть еще один период после следующего
+            if i + 2 < len(periods) and periods[i + 2]["category"] in ["rain", "snow"]:
+                break_duration = (periods[i + 2]["start_time"] - next_period["start_time"]).total_seconds() / 3600
+
+                # Если перерыв короткий (менее 6 часов)
+                if break_duration <= 6:
+                    # Форматируем сообщение о временном перерыве в осадках
+                    weather_type = "дождь" if current_period["category"] == "rain" else "снег"
+                    start_break = next_period["start_time"].strftime("%d.%m в %H:%M")
+                    end_break = periods[i + 2]["start_time"].strftime("%d.%m в %H:%M")
+
+                    msg = (
+                        f"⏱️ Прогноз изменения осадков в {city.capitalize()}:\n"
+                        f"Ожидается перерыв в осадках ({weather_type}) с {start_break} до {end_break} "
+                        f"({int(break_duration)} час{'а' if 1 < break_duration < 5 else 'ов'})\n"
+                        f"После перерыва осадки возобновятся."
+                    )
+                    events.append(alert_event("precip_break", city, next_period, msg))
+                    continue
+
+        # 2. Начало осадков
+        if (current_period["category"] not in ["rain", "snow"] and
+                next_period["category"] in ["rain", "snow"]):
+
+            rain_start = next_period["start_time"].strftime("%d.%m в %H:%M")
+            weather_type = "дождь" if next_period["category"] == "rain" else "снег"
+
+            # Оцениваем продолжительность осадков
+            rain_duration = (next_period["end_time"] - next_period["start_time"]).total_seconds() / 3600
+
+            duration_text = ""
+            if 3 > rain_duration > 1:
+                duration_text = f"(кратковременный, около {int(rain_duration)} час{'а' if 1 < rain_duration < 5 else 'ов'})"
+            elif 1 >= rain_duration > 0:
+                duration_text = f"(кратковременный, около {int(rain_duration * 60)} минут)"
+            elif rain_duration >= 3:
+                duration_text = f"(продолжительный, около {int(rain_duration)} час{'ов' if rain_duration >= 5 else 'а'})"
+
+            msg = (
+                f"🌧️ Прогноз начала осадков в {city.capitalize()}:\n"
+                f"Ожидается {weather_type} с {rain_start} {duration_text}"
+            )
+            if next_period["max_precip"] is not None:
+                msg += f"\nВероятность осадков: до {next_period['max_precip']}%"
+            events.append(alert_event("precip_start", city, next_period, msg))
+
+        # 3. Резкое изменение температуры между периодами
+        temp_diff = next_period["avg_temp"] - current_period["avg_temp"]
+
+        if abs(temp_diff) > 6:
+            change_time = next_period["start_time"].strftime("%d.%m в %H:%M")
+            direction = "потепления" if temp_diff > 0 else "похолодания"
+
+            msg = (
+                f"🌡️ Прогноз резкого изменения температуры в {city.capitalize()}:\n"
+                f"Ожидается {direction} на {abs(temp_diff):.1f}°C с {change_time}"
+            )
+            events.append(alert_event("temp_change", city, next_period, msg))
+
+        # 4. Сильный ветер
+        avg_wind_speed_current = current_period["avg_wind"]
+        avg_wind_speed_next = next_period["avg_wind"]
+
+        # Если ветер усилится до значительного уровня
+        if avg_wind_speed_next > 15 and avg_wind_speed_next > avg_wind_speed_current * 1.5:
+            change_time = next_period["start_time"].strftime("%d.%m в %H:%M")
+
+            msg = (
+                f"💨 Предупреждение о ветре в {city.capitalize()}:\n"
+                f"С {change_time} ожидается усиление ветра до {avg_wind_speed_next:.1f} км/ч\n"
+                f"Будьте осторожны на улице!"
+            )
+            events.append(alert_event("wind", city, next_period, msg))
+
+        # 5. Предупреждение о тумане
+        if next_period["category"] == "fog" and current_period["category"] != "fog":
+            fog_time = next_period["start_time"].strftime("%d.%m в %H:%M")
+
+            msg = (
+                f"🌫️ Предупреждение о тумане в {city.capitalize()}:\n"
+                f"С {fog_time} ожидается туман. Видимость будет ограничена.\n"
+                f"Будьте внимательны на дорогах!"
+            )
+            events.append(alert_event("fog", city, next_period, msg))
+
+    return events
+
+
+# Ограничение Telegram на длину сообщения
+TELEGRAM_MESSAGE_LIMIT = 4096
 
-        # Проверяем, отправляли ли мы уже уведомление об этом переходе
-        if period_pair_key in last_weather[user_id][city]["sent_notifications"]:
+
+def split_message(parts, separator="\n\n", limit=TELEGRAM_MESSAGE_LIMIT):
+    """
+    Склеивает части в сообщения, начиная новое, только если следующая часть не помещается в лимит
+    """
+    chunks = []
+    current = ""
+    for part in parts:
+        candidate = f"{current}{separator}{part}" if current else part
+        if len(candidate) <= limit:
+            current = candidate
             continue
 
-        # Временные рамки для отправки уведомлений
-        hours_until_change = (next_period["start_time"] - now).total_seconds() / 3600
-
-        # Уведомляем только о будущих изменениях в пределах 24 часов
-        if 0 <= hours_until_change <= 24:
-            # Проверяем различные паттерны
-
-            # 1. Прекращение осадков на короткое время
-            if (current_period["category"] in ["rain", "snow"] and
-                    next_period["category"] not in ["rain", "snow"]):
-
-                # Если есть еще один период после следующего
-                if i + 2 < len(periods) and periods[i + 2]["category"] in ["rain", "snow"]:
-                    break_duration = (periods[i + 2]["start_time"] - next_period["start_time"]).total_seconds() / 3600
-
-                    # Если перерыв короткий (менее 6 часов)
-                    if break_duration <= 6:
-                        # Форматируем сообщение о временном перерыве в осадках
-                        weather_type = "дождь" if current_period["category"] == "rain" else "снег"
-                        start_break = next_period["start_time"].strftime("%d.%m в %H:%M")
-                        end_break = periods[i + 2]["start_time"].strftime("%d.%m в %H:%M")
-
-                        msg = (
-                            f"⏱️ Прогноз изменения осадков в {city.capitalize()}:\n"
-                            f"Ожидается перерыв в осадках ({weather_type}) с {start_break} до {end_break} "
-                            f"({int(break_duration)} час{'а' if 1 < break_duration < 5 else 'ов'})\n"
-                            f"После перерыва осадки возобновятся."
-                        )
-                        alerts.append(msg)
-
-                        # Отмечаем, что отправили уведомление для этой пары периодов
-                        last_weather[user_id][city]["sent_notifications"][period_pair_key] = True
-                        continue
-
-            # 2. Начало осадков
-            if (current_period["category"] not in ["rain", "snow"] and
-                    next_period["category"] in ["rain", "snow"]):
-
-                rain_start = next_period["start_time"].strftime("%d.%m в %H:%M")
-                weather_type = "дождь" if next_period["category"] == "rain" else "снег"
-
-                # Оцениваем продолжительность осадков
-                rain_duration = (next_period["end_time"] - next_period["start_time"]).total_seconds() / 3600
-
-                duration_text = ""
-                if 3 > rain_duration > 1:
-                    duration_text = f"(кратковременный, около {int(rain_duration)} час{'а' if 1 < rain_duration < 5 else 'ов'})"
-                elif 1 >= rain_duration > 0:
-                    duration_text = f"(кратковременный, около {int(rain_duration * 60)} минут)"
-                elif rain_duration >= 3:
-                    duration_text = f"(продолжительный, около {int(rain_duration)} час{'ов' if rain_duration >= 5 else 'а'})"
-
-                msg = (
-                    f"🌧️ Прогноз начала осадков в {city.capitalize()}:\n"
-                    f"Ожидается {weather_type} с {rain_start} {duration_text}"
-                )
-                alerts.append(msg)
+        if current:
+            chunks.append(current)
+        while len(part) > limit:
+            chunks.append(part[:limit])
+            part = part[limit:]
+        current = part
 
-                # Отмечаем, что отправили уведомление для этой пары периодов
-                last_weather[user_id][city]["sent_notifications"][period_pair_key] = True
+    if current:
+        chunks.append(current)
+    return chunks
 
-            # 3. Резкое изменение температуры между периодами
-            curr_avg_temp = sum(f["temp"] for f in current_period["forecasts"]) / len(current_period["forecasts"])
-            next_avg_temp = sum(f["temp"] for f in next_period["forecasts"]) / len(next_period["forecasts"])
 
-            temp_diff = next_avg_temp - curr_avg_temp
+async def deliver_alert_digests(user_alerts):
+    """
+    Отправляет каждому пользователю одну сводку уведомлений по всем его городам,
+    упорядоченную по времени наступления событий
+    """
+    for user_id, alerts in user_alerts.items():
+        alerts.sort(key=lambda alert: alert[0])
+        for text in split_message(msg for _, msg in alerts):
+            try:
+                await bot.send_message(int(user_id), text)
+            except Exception as e:
+                logger.error(f"Ошибка отправки сообщения пользователю {user_id}: {e}")
+                break
 
-            if abs(temp_diff) > 6:
-                change_time = next_period["start_time"].strftime("%d.%m в %H:%M")
-                direction = "потепления" if temp_diff > 0 else "похолодания"
 
-                msg = (
-                    f"🌡️ Прогноз резкого изменения температуры в {city.capitalize()}:\n"
-                    f"Ожидается {direction} на {abs(temp_diff):.1f}°C с {change_time}"
-                )
-                alerts.append(msg)
+# Группировка подписчиков по городам (чтобы готовить прогноз один раз на город)
+def get_city_subscribers():
+    """
+    Возвращает словарь {город: [user_id, ...]} по текущим подпискам
+    """
+    city_subscribers = {}
+    for user_id, cities in user_subscriptions.items():
+        for city in cities:
+            city_subscribers.setdefault(city, []).append(user_id)
+    return city_subscribers
+
+
+def build_daily_forecast_block(city, today_forecast):
+    """
+    Формирует общую для всех подписчиков часть утреннего прогноза.
 
-                # Отмечаем, что отправили уведомление для этой пары периодов
-                last_weather[user_id][city]["sent_notifications"][period_pair_key] = True
+    Возвращает кортеж (текст прогноза, параметры для комментария Нами)
+    """
+    # Получаем дату
+    date = today_forecast["date"].strftime('%d.%m.%Y')
+
+    # Температуры
+    min_temp = today_forecast["min_temp"]
+    max_temp = today_forecast["max_temp"]
+
+    # Описание дня и ночи
+    day_desc = today_forecast["day"]["desc"]
+    night_desc = today_forecast["night"]["desc"]
+
+    # Ветер
+    day_wind = today_forecast["day"]["wind_speed"]
+    night_wind = today_forecast["night"]["wind_speed"]
+
+    # Вероятность осадков
+    day_precip_prob = today_forecast["day"]["precip_prob"]
+    night_precip_prob = today_forecast["night"]["precip_prob"]
+
+    weather_text = (
+        f"☀️ Доброе утро! Прогноз погоды на сегодня, {date}\n"
+        f"🌍 **{city.capitalize()}**\n"
+        f"---------------------------------\n"
+        f"🌡 *Температура:* от {min_temp}°C до {max_temp}°C\n"
+        f"☀️ *Днем:* {day_desc} (вероятность осадков: {day_precip_prob}%)\n"
+        f"🌙 *Ночью:* {night_desc} (вероятность осадков: {night_precip_prob}%)\n"
+        f"💨 *Ветер:* днем - {day_wind} км/ч, ночью - {night_wind} км/ч\n"
+    )
+    return weather_text, (day_desc, day_wind, max_temp)
 
-            # 4. Сильный ветер
-            avg_wind_speed_current = sum(f["wind_speed"] for f in current_period["forecasts"]) / len(
-                current_period["forecasts"])
-            avg_wind_speed_next = sum(f["wind_speed"] for f in next_period["forecasts"]) / len(next_period["forecasts"])
 
-            # Если ветер усилится до значительного уровня
-            if avg_wind_speed_next > 15 and avg_wind_speed_next > avg_wind_speed_current * 1.5:
-                change_time = next_period["start_time"].strftime("%d.%m в %H:%M")
+async def build_daily_digest_payloads(city_subscribers):
+    """
+    Готовит утренние сообщения: прогноз запрашивается и форматируется один раз на город,
+    для каждого получателя добавляется только комментарий Нами.
 
-                msg = (
-                    f"💨 Предупреждение о ветре в {city.capitalize()}:\n"
-                    f"С {change_time} ожидается усиление ветра до {avg_wind_speed_next:.1f} км/ч\n"
-                    f"Будьте осторожны на улице!"
-                )
-                alerts.append(msg)
+    Возвращает список пар (user_id, текст сообщения)
+    """
+    payloads = []
+    for city, user_ids in city_subscribers.items():
+        # Получаем прогноз на день
+        data = await fetch_daily_forecast(city)
+        if not data:
+            logger.warning(f"Не удалось получить ежедневный прогноз для города {city}")
+            continue
 
-                # Отмечаем, что отправили уведомление
-                last_weather[user_id][city]["sent_notifications"][period_pair_key] = True
+        weather_text, comment_args = build_daily_forecast_block(city, data)
 
-            # 5. Предупреждение о тумане
-            if next_period["category"] == "fog" and current_period["category"] != "fog":
-                fog_time = next_period["start_time"].strftime("%d.%m в %H:%M")
+        # Общий комментарий для всех подписчиков города, если так настроено
+        shared_comment = generate_weather_description(*comment_args) if DIGEST_SHARED_COMMENTARY else None
 
-                msg = (
-                    f"🌫️ Предупреждение о тумане в {city.capitalize()}:\n"
-                    f"С {fog_time} ожидается туман. Видимость будет ограничена.\n"
-                    f"Будьте внимательны на дорогах!"
-                )
-                alerts.append(msg)
+        for user_id in user_ids:
+            comment = shared_comment if shared_comment is not None else generate_weather_description(*comment_args)
+            payloads.append((user_id, weather_text + comment))
 
-                # Отмечаем, что отправили уведомление
-                last_weather[user_id][city]["sent_notifications"][period_pair_key] = True
+    return payloads
 
-    # Отправляем все уведомления одним сообщением
-    if alerts:
+
+async def deliver_digest_payloads(payloads):
+    """
+    Отправляет готовые сообщения утреннего прогноза
+    """
+    for user_id, weather_text in payloads:
         try:
-            await bot.send_message(int(user_id), "\n\n".join(alerts))
+            await bot.send_message(int(user_id), weather_text, parse_mode=ParseMode.MARKDOWN)
         except Exception as e:
-            logger.error(f"Ошибка отправки сообщения пользователю {user_id}: {e}")
+            logger.error(f"Ошибка отправки ежедневного прогноза пользователю {user_id}: {e}")
+
+
+@background_lane
+async def prefetch_daily_forecasts(cities, window):
+    """
+    Заранее загружает дневные прогнозы городов в кэш, равномерно распределяя
+    запросы по окну в window секунд, чтобы не упираться в лимиты API
+    """
+    if not cities:
+        return
+
+    interval = window / len(cities)
+    for city in cities:
+        started = clock.time()
+        await fetch_daily_forecast(city)
+        await clock.sleep(max(0, interval - (clock.time() - started)))
+
+
+@background_lane
+async def broadcast_daily_forecast():
+    """
+    Собирает утренний прогноз из прогретых данных и рассылает его подписчикам.
+    Города, по которым рассылка за сегодня уже прошла на любом экземпляре, пропускаются,
+    поэтому повторный вызов досылает только то, что не было отправлено
+    """
+    record_traffic("cycle", {"loop": "daily_forecast"})
+
+    # Рассылаем только по городам, закрепленным за этим экземпляром. Кольцо перестраиваем
+    # прямо перед арендой: иначе оно может быть устаревшим на PARTITION_LEASE_TTL / 3
+    if partitioner is not None:
+        await partition_heartbeat()
+    day = clock.now().strftime("%Y-%m-%d")
+    city_subscribers = get_city_subscribers()
+    owned_cities = await get_owned_cities(city_subscribers)
+    sent_cities = await get_sent_digests(owned_cities, day)
+    city_subscribers = {
+        city: user_ids for city, user_ids in city_subscribers.items()
+        if city in owned_cities and city not in sent_cities
+    }
+    if not city_subscribers:
+        return
+
+    # Считаем, сколько сообщений можно собрать из уже прогретых данных
+    ready_payloads = sum(
+        len(user_ids) for city, user_ids in city_subscribers.items()
+        if has_fresh_data(city, "daily")
+    )
+    total_payloads = sum(len(user_ids) for user_ids in city_subscribers.values())
+    logger.info(f"Утренняя рассылка: прогрето {ready_payloads} из {total_payloads} сообщений")
+
+    # Готовим прогноз один раз на город и отправляем подписчикам. Отметку в общей базе
+    # ставим сразу после города, чтобы после падения экземпляра повторить как можно меньше
+    for city, user_ids in city_subscribers.items():
+        payloads = await build_daily_digest_payloads({city: user_ids})
+        if not payloads:
+            continue
+        await deliver_digest_payloads(payloads)
+        await share_sent_digest(city, day)
+
+
+async def run_daily_digest():
+    """
+    Утренняя рассылка с повторным проходом при нескольких экземплярах
+    """
+    await broadcast_daily_forecast()
+    if partitioner is None:
+        return
+
+    # Экземпляр, упавший перед рассылкой, еще числится в кольце, и его города никто не разослал.
+    # Через PARTITION_LEASE_TTL с запасом на один интервал продления его аренды истекают,
+    # и города без отметки за сегодня достаются живым экземплярам
+    await clock.sleep(PARTITION_LEASE_TTL * 4 / 3)
+    await broadcast_daily_forecast()
 
 
 # Периодическая отправка прогноза погоды подписчикам
 async def send_daily_forecast():
     """
-    Отправляет ежедневный прогноз погоды всем подписчикам утром (8:00)
+    Отправляет ежедневный прогноз погоды всем подписчикам утром (8:00).
+    За DIGEST_PREFETCH_WINDOW секунд до отправки прогревает кэш прогнозов подписанных городов.
     """
     while True:
         # Получаем текущее время
-        now = datetime.now()
+        now = clock.now()
 
         # Рассчитываем время до 8 утра следующего дня
         target_time = now.replace(hour=8, minute=0, second=0, microsecond=0)
         if now.hour >= 8:
             target_time += timedelta(days=1)
 
-        # Вычисляем сколько секунд осталось ждать
-        seconds_to_wait = (target_time - now).total_seconds()
+        # Ждем начала окна прогрева
+        prefetch_time = target_time - timedelta(seconds=DIGEST_PREFETCH_WINDOW)
+        if prefetch_time > now:
+            await clock.sleep((prefetch_time - now).total_seconds())
 
-        # Ждем до целевого времени
-        await asyncio.sleep(seconds_to_wait)
+        # Прогреваем кэш, пока ждем целевого времени
+        seconds_to_wait = max(0, (target_time - clock.now()).total_seconds())
+        prefetch_task = asyncio.create_task(
+            prefetch_daily_forecasts(sorted(await get_owned_cities(get_city_subscribers())), seconds_to_wait)
+        )
+        await clock.sleep(seconds_to_wait)
+        if not prefetch_task.done():
+            prefetch_task.cancel()
 
-        # Отправляем прогноз каждому подписчику
-        for user_id, cities in user_subscriptions.items():
-            for city in cities:
-                try:
-                    # Получаем прогноз на день
-                    data = await fetch_daily_forecast(city)
-
-                    if data:
-                        # Берем только прогноз на сегодня
-                        today_forecast = data['DailyForecasts'][0]
-
-                        # Получаем дату
-                        date = datetime.strptime(today_forecast['Date'], "%Y-%m-%dT%H:%M:%S%z").strftime('%d.%m.%Y')
-
-                        # Температуры
-                        min_temp = today_forecast['Temperature']['Minimum']['Value']
-                        max_temp = today_forecast['Temperature']['Maximum']['Value']
-
-                        # Описание дня и ночи
-                        day_desc = today_forecast['Day']['IconPhrase']
-                        night_desc = today_forecast['Night']['IconPhrase']
-
-                        # Ветер
-                        day_wind = today_forecast['Day']['Wind']['Speed']['Value']
-                        night_wind = today_forecast['Night']['Wind']['Speed']['Value']
-
-                        # Вероятность осадков
-                        day_precip_prob = today_forecast['Day'].get('PrecipitationProbability', 0)
-                        night_precip_prob = today_forecast['Night'].get('PrecipitationProbability', 0)
-
-                        weather_text = (
-                            f"☀️ Доброе утро! Прогноз погоды на сегодня, {date}\n"
-                            f"🌍 **{city.capitalize()}**\n"
-                            f"---------------------------------\n"
-                            f"🌡 *Температура:* от {min_temp}°C до {max_temp}°C\n"
-                            f"☀️ *Днем:* {day_desc} (вероятность осадков: {day_precip_prob}%)\n"
-                            f"🌙 *Ночью:* {night_desc} (вероятность осадков: {night_precip_prob}%)\n"
-                            f"💨 *Ветер:* днем - {day_wind} км/ч, ночью - {night_wind} км/ч\n"
-                            f"{generate_weather_description(day_desc, day_wind, max_temp)}"
-                        )
-
-                        await bot.send_message(int(user_id), weather_text, parse_mode=ParseMode.MARKDOWN)
-                except Exception as e:
-                    logger.error(f"Ошибка отправки ежедневного прогноза пользователю {user_id} для города {city}: {e}")
+        await run_daily_digest()
 
         # Если отправка заняла время, корректируем следующий цикл
-        await asyncio.sleep(60)  # Защита от случайного выполнения цикла слишком быстро
+        await clock.sleep(60)  # Защита от случайного выполнения цикла слишком быстро
+
+
+def inline_result_id(kind, city):
+    """
+    Стабильный идентификатор inline-результата, чтобы Telegram мог кэшировать ответы
+    """
+    return hashlib.md5(f"{kind}:{city}".encode("utf-8")).hexdigest()
+
+
+# Карточки inline-ответа: (вид карточки, заголовок, вид данных, форматирование)
+INLINE_CARDS = (
+    ("now", "🌦 Погода сейчас", "current", format_current_weather),
+    ("3h", "⏳ Прогноз на 12 часов", "hourly", format_hourly_forecast),
+    ("day", "📅 Прогноз на день", "daily", format_daily_forecast),
+)
+
+
+def build_inline_card(kind, title, city, data, formatter):
+    try:
+        text = formatter(city, data)
+    except (KeyError, IndexError) as e:
+        logger.error(f"Ошибка получения данных из ответа API: {e}")
+        return None
+    return types.InlineQueryResultArticle(
+        id=inline_result_id(kind, city),
+        title=f"{title}: {city.capitalize()}",
+        description=text.split("\n", 1)[0].replace("*", ""),
+        input_message_content=types.InputTextMessageContent(text, parse_mode=ParseMode.MARKDOWN),
+    )
+
+
+async def build_inline_results(city):
+    """
+    Собирает карточки текущей погоды, прогноза на 12 часов и на день одним планом запросов.
+    Если план не успел к INLINE_ANSWER_DEADLINE, он продолжает выполняться, и данные попадут в кэш
+    """
+    task = asyncio.ensure_future(fetch_weather_data(city, [data_kind for _, _, data_kind, _ in INLINE_CARDS]))
+    done, _ = await asyncio.wait([task], timeout=INLINE_ANSWER_DEADLINE)
+    if not done or task.exception():
+        return []
+
+    results = []
+    for kind, title, data_kind, formatter in INLINE_CARDS:
+        data = task.result().get(data_kind)
+        card = build_inline_card(kind, title, city, data, formatter) if data else None
+        if card:
+            results.append(card)
+    return results
+
+
+def build_cached_inline_results(user_id, query):
+    """
+    Карточки только из кэша: сам запрос и города пользователя, начинающиеся с него
+    """
+    cities = [query] if query else []
+    cities += [city for city in get_quick_cities(user_id) if city.startswith(query) and city != query]
+
+    results = []
+    for city in cities:
+        for kind, title, data_kind, formatter in INLINE_CARDS:
+            data = get_cached_response(data_kind, city)
+            card = build_inline_card(kind, title, city, data, formatter) if data else None
+            if card:
+                results.append(card)
+    return results
+
+
+# Последний inline-запрос каждого пользователя, который еще ждет окончания набора
+inline_pending_queries = {}  # {user_id: id inline-запроса}
+
+
+@dp.inline_handler()
+async def inline_weather(inline_query: types.InlineQuery):
+    """
+    Отвечает на inline-запрос вида «@bot город» карточками погоды.
+    Telegram присылает запрос на каждое нажатие клавиши: к поставщику идет только запрос
+    не короче INLINE_MIN_QUERY_LENGTH, после которого пользователь INLINE_TYPING_DELAY
+    секунд ничего не дописывал. Остальные получают то, что уже есть в кэше
+    """
+    await ensure_subscriptions_loaded()
+    user_id = inline_query.from_user.id
+    city = inline_query.query.strip().lower()
+
+    results = []
+    if len(city) >= INLINE_MIN_QUERY_LENGTH:
+        inline_pending_queries[user_id] = inline_query.id
+        await clock.sleep(INLINE_TYPING_DELAY)
+        if inline_pending_queries.get(user_id) == inline_query.id:
+            del inline_pending_queries[user_id]
+            results = await build_inline_results(city)
+    else:
+        # Пользователь стер запрос: ожидающий более длинный запрос уже не нужен
+        inline_pending_queries.pop(user_id, None)
+
+    if results:
+        await inline_query.answer(results, cache_time=INLINE_CACHE_TIME, is_personal=False)
+        return
+
+    # Ответ из кэша зависит от городов пользователя и скоро устареет
+    results = build_cached_inline_results(str(user_id), city)
+    await inline_query.answer(results, cache_time=5, is_personal=True)
+
+
+# Символы для графика температуры в /trend
+TREND_BARS = "▁▂▃▄▅▆▇█"
+
+
+def format_trend(city, series):
+    """
+    Форматирует тренд по почасовому ряду города: график температуры, осадки
+    и отличие от предыдущей ревизии прогноза
+    """
+    start, temp, wind, precip, category = series.columns()
+    low, high = min(temp), max(temp)
+    scale = (len(TREND_BARS) - 1) / (high - low) if high > low else 0
+    sparkline = "".join(TREND_BARS[int((value - low) * scale)] for value in temp)
+    first_hour = SERIES_EPOCH + timedelta(hours=start)
+    last_hour = first_hour + timedelta(hours=len(temp) - 1)
+
+    lines = [
+        f"📈 *Тренд погоды в {city.capitalize()}* ({first_hour:%H:%M}–{last_hour:%H:%M})\n",
+        f"🌡 {sparkline}",
+        f"Температура: от {low:.0f}°C до {high:.0f}°C ({temp[0]:.0f}°C → {temp[-1]:.0f}°C)",
+        f"💨 Ветер до {max(wind):.0f} км/ч",
+    ]
+
+    if SERIES_MISSING not in precip:
+        rainy_hours = [offset for offset, value in enumerate(precip) if value >= 50]
+        if rainy_hours:
+            rain_start = first_hour + timedelta(hours=rainy_hours[0])
+            lines.append(f"☔ Осадки вероятны с {rain_start:%H:%M} (до {max(precip)}%)")
+        else:
+            lines.append(f"☀️ Осадки маловероятны (до {max(precip)}%)")
+
+    # Сравниваем общие часы с предыдущей ревизией прогноза
+    previous = series.columns(1)
+    if previous:
+        shift = start - previous[0]
+        overlap = min(len(temp), len(previous[1]) - shift) if shift >= 0 else 0
+        if overlap > 0:
+            diff = (sum(temp[:overlap]) - sum(previous[1][shift:shift + overlap])) / overlap
+            if abs(diff) >= 0.5:
+                direction = "теплее" if diff > 0 else "холоднее"
+                lines.append(f"🔄 Прогноз стал {direction} в среднем на {abs(diff):.1f}°C")
+            else:
+                lines.append("🔄 Прогноз по сравнению с прошлым почти не изменился")
+
+    return "\n".join(lines)
+
+
+@dp.message_handler(commands=['trend'])
+async def trend_command(message: types.Message):
+    """Показывает тренд погоды по сохраненному почасовому ряду города"""
+    await ensure_subscriptions_loaded()
+    city = message.get_args().strip().lower()
+    if not city:
+        quick_cities = get_quick_cities(str(message.from_user.id))
+        if not quick_cities:
+            await message.answer("Укажите город: /trend Москва")
+            return
+        city = quick_cities[0]
+
+    # Ряд обновляется мониторингом; запрашиваем прогноз, только если ряда нет или он устарел
+    series = city_series.get(city)
+    if not series or clock.time() - series.fetched_at[series.latest] > WEATHER_MONITOR_INTERVAL:
+        series = await update_city_series(city)
+    if not series:
+        await message.answer("❌ Ошибка! Не удалось получить прогноз для этого города.")
+        return
+
+    remember_city(str(message.from_user.id), city)
+    await message.answer(format_trend(city, series), parse_mode=ParseMode.MARKDOWN)
+
+
+# Последнее определенное место пользователей, приславших геопозицию (ограниченный LRU)
+tracked_locations = OrderedDict()  # {user_id: {"lat", "lon", "provider", "location", "place", "current", ...}}
+
+
+def distance_meters(lat1, lon1, lat2, lon2):
+    """Расстояние между точками по поверхности Земли (формула гаверсинусов)"""
+    phi1, phi2 = math.radians(lat1), math.radians(lat2)
+    half_dphi = (phi2 - phi1) / 2
+    half_dlambda = math.radians(lon2 - lon1) / 2
+    a = math.sin(half_dphi) ** 2 + math.cos(phi1) * math.cos(phi2) * math.sin(half_dlambda) ** 2
+    return 2 * 6371000 * math.asin(math.sqrt(a))
+
+
+# Поля записи tracked_locations, описывающие определенное место и его погоду
+LOCATION_PLACE_FIELDS = ("lat", "lon", "provider", "location", "place", "current", "fetched_at")
+
+
+async def resolve_location_weather(tracked, lat, lon):
+    """
+    Обновляет место и текущую погоду в записи tracked. Место определяется заново, только если
+    пользователь сместился дальше LOCATION_REFETCH_DISTANCE, погода запрашивается, только если
+    устарела. После неудачи следующая попытка — не раньше retry_at. Возвращает True, если данные обновились
+    """
+    moved = "lat" not in tracked or (
+        distance_meters(tracked["lat"], tracked["lon"], lat, lon) >= LOCATION_REFETCH_DISTANCE
+    )
+    if moved:
+        # Прежнее место к новой позиции не относится, даже если определить новое не удастся
+        for field in LOCATION_PLACE_FIELDS:
+            tracked.pop(field, None)
+    elif clock.time() - tracked["fetched_at"] < CURRENT_WEATHER_CACHE_TTL:
+        return False
+    if clock.time() < tracked.get("retry_at", 0):
+        return False
+
+    current = None
+    if not moved:
+        # Место прежнее: погода по уже известной локации, без повторного геокодирования
+        current = await weather_router.request_from(tracked["provider"], "current", tracked["location"])
+    if current is None:
+        found = await weather_router.request("fetch_at", "current", lat, lon)
+        if not found:
+            failures = tracked.get("failures", 0) + 1
+            retry_delay = min(LOCATION_RETRY_DELAY * 2 ** (failures - 1), CURRENT_WEATHER_CACHE_TTL)
+            tracked["failures"] = failures
+            tracked["retry_at"] = clock.time() + retry_delay
+            logger.warning(
+                f"Не удалось получить текущую погоду для координат {lat}, {lon}, повтор через {retry_delay} сек."
+            )
+            return False
+        tracked["provider"], tracked["location"], tracked["place"], current = found
+        tracked["lat"], tracked["lon"] = lat, lon
+
+    tracked["current"] = current
+    tracked["fetched_at"] = clock.time()
+    tracked.pop("failures", None)
+    tracked.pop("retry_at", None)
+    return True
+
+
+@dp.message_handler(content_types=types.ContentType.LOCATION)
+@dp.edited_message_handler(content_types=types.ContentType.LOCATION)
+async def track_location(message: types.Message):
+    """
+    Погода по геопозиции. При трансляции Telegram каждые несколько секунд присылает правку
+    исходного сообщения: на них редактируется один и тот же ответ (погода или ошибка),
+    а поставщики запрашиваются только при заметном перемещении или устаревании погоды
+    """
+    user_id = str(message.from_user.id)
+    tracked = tracked_locations.pop(user_id, None) or {}
+    tracked_locations[user_id] = tracked
+    while len(tracked_locations) > LOCATION_USERS_LIMIT:
+        tracked_locations.popitem(last=False)
+
+    # Пока идет запрос, следующие правки трансляции пропускаем: придут новые
+    if message.edit_date is not None and tracked.get("pending"):
+        return
+    tracked["pending"] = True
+    try:
+        await resolve_location_weather(tracked, message.location.latitude, message.location.longitude)
+    finally:
+        tracked["pending"] = False
+
+    # Что показывает ответ: время получения погоды или None для сообщения об ошибке
+    shown = tracked.get("fetched_at")
+    if shown is None:
+        text = "❌ Ошибка! Не удалось получить погоду для вашего местоположения."
+    else:
+        text = format_location_weather(tracked["place"], tracked["current"])
+        if message.location.live_period:
+            text += "\n\n📡 Обновляется, пока вы транслируете геопозицию"
+
+    source = (message.chat.id, message.message_id)
+    if message.edit_date is not None and tracked.get("source") == source:
+        if tracked.get("shown") == shown:
+            return
+        try:
+            await bot.edit_message_text(text, message.chat.id, tracked["reply_id"])
+            tracked["shown"] = shown
+            return
+        except MessageNotModified:
+            tracked["shown"] = shown
+            return
+        except TelegramAPIError as e:
+            # Ответ удален или слишком старый для правки: отправляем новый
+            logger.warning(f"Не удалось обновить погоду по геопозиции для {user_id}: {e}")
+
+    reply = await message.answer(text)
+    tracked["source"] = source
+    tracked["reply_id"] = reply.message_id
+    tracked["shown"] = shown
 
 
 @dp.message_handler(commands=['help'])
@@ -1005,6 +2958,7 @@ async def help_command(message: types.Message):
         "• /Pogoda_now - Узнать текущую погоду в указанном городе\n"
         "• /Pogoda_day - Прогноз погоды на день\n"
         "• /pogoda_every_3h - Прогноз каждые 3 часа на ближайшие 12 часов\n"
+        "• /trend - Тренд температуры и осадков на ближайшие часы\n"
         "• /subscribe - Подписаться на обновления погоды\n"
         "• /subs - Посмотреть свои текущие подписки\n"
         "• /unsubscribe - Отписаться от обновлений погоды\n"
@@ -1020,36 +2974,16 @@ async def process_text_message(message: types.Message):
     city = message.text.strip().lower()
 
     # Проверяем, является ли текст названием города
-    location_key = await get_location_key(city)
+    location = await find_city(city)
 
-    if location_key:
+    if location:
         # Если это название города, отправляем текущую погоду
+        remember_city(str(message.from_user.id), city)
         data = await fetch_current_weather(city)
 
         if data:
             try:
-                temp = data['Temperature']['Metric']['Value']
-                desc = data['WeatherText']
-                wind_speed = data['Wind']['Speed']['Metric']['Value']
-
-                # Получаем местное время из временной метки наблюдения
-                observation_time = datetime.strptime(data['LocalObservationDateTime'], "%Y-%m-%dT%H:%M:%S%z")
-                local_time = observation_time.strftime('%H:%M')
-
-                is_day = data.get('IsDayTime', True)
-                emoji = "🏙️" if is_day else "🌃"
-
-                weather_text = (
-                    f"{emoji} **{city.capitalize()}**\n"
-                    f"🕒 *Local Time:* {local_time}\n"
-                    f"---------------------------------\n"
-                    f"🌡 *Temperature:* {temp}°C\n"
-                    f"🌫 *Condition:* {desc}\n"
-                    f"💨 *Wind:* {wind_speed} км/ч\n"
-                    f"{generate_weather_description(desc, wind_speed, temp)}"
-                )
-
-                await message.answer(weather_text, parse_mode=ParseMode.MARKDOWN)
+                await message.answer(format_current_weather(city, data), parse_mode=ParseMode.MARKDOWN)
             except KeyError as e:
                 logger.error(f"Ошибка получения данных из ответа API: {e}")
                 await message.answer("❌ Произошла ошибка при обработке данных о погоде.")
@@ -1066,19 +3000,76 @@ async def process_text_message(message: types.Message):
         )
 
 
+# Завершение прогрева после старта и задача прогрева в режиме быстрого старта
+warm_start_done = asyncio.Event()
+warm_start_state = {"task": None}
+
+
+async def warm_start():
+    """
+    Загружает подписки и снимок состояния, затем запускает фоновые задачи
+    """
+    await ensure_subscriptions_loaded()
+    if partitioner:
+        await partition_heartbeat()
+
+    # Восстанавливаем кэши и отправленные уведомления из последнего снимка
+    state = await asyncio.get_running_loop().run_in_executor(None, read_state_snapshot)
+    if state:
+        restore_state_snapshot(state)
+    warm_start_done.set()
+
+    # Даем первым обновлениям обработаться без конкуренции с фоновыми задачами
+    if FAST_START:
+        await clock.sleep(BACKGROUND_START_DELAY)
+
+    # Запускаем фоновые задачи
+    if partitioner:
+        asyncio.create_task(partition_heartbeat_loop())
+    asyncio.create_task(weather_monitor())
+    asyncio.create_task(send_daily_forecast())
+    asyncio.create_task(snapshot_loop())
+    asyncio.create_task(metrics_loop())
+    logger.info("Прогрев завершен, фоновые задачи запущены")
+
+
+def on_warm_start_finished(task):
+    """
+    Останавливает бота, если прогрев в фоне завершился ошибкой: без него не работают
+    мониторинг, рассылка и снимки состояния
+    """
+    if task.cancelled() or task.exception() is None:
+        return
+    error = task.exception()
+    logger.error(f"Ошибка прогрева, бот останавливается: {error!r}", exc_info=error)
+    dp.stop_polling()
+
+
 # Инициализация HTTP сессии при старте
 async def on_startup(dp):
     global session
     session = aiohttp.ClientSession()
 
-    # Запускаем фоновые задачи
-    asyncio.create_task(weather_monitor())
-    asyncio.create_task(send_daily_forecast())
+    if FAST_START:
+        # Начинаем принимать обновления сразу, прогрев идет в фоне
+        task = warm_start_state["task"] = asyncio.create_task(warm_start())
+        task.add_done_callback(on_warm_start_finished)
+    else:
+        await warm_start()
 
     logger.info("Бот запущен и готов к работе")
 
 
 async def on_shutdown(dp):
+    # Не перезаписываем снимок, если он еще не был загружен
+    if warm_start_done.is_set():
+        save_state_snapshot()
+    if partitioner:
+        try:
+            await partitioner.run("release")
+        except sqlite3.Error as e:
+            logger.error(f"Ошибка освобождения аренды экземпляра {INSTANCE_ID}: {e}")
+
     # Закрываем сессию при выключении бота
     if session:
         await session.close()
@@ -1086,4 +3077,6 @@ async def on_shutdown(dp):
 
 
 if __name__ == "__main__":
+    from aiogram.utils import executor
+
     executor.start_polling(dp, skip_updates=True, on_startup=on_startup, on_shutdown=on_shutdown)
\ No newline at end of file
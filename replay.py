@@ -0,0 +1,285 @@
+"""
+Воспроизведение записанного трафика бота против локальных заглушек.
+
+Запись включается переменной окружения TRAFFIC_RECORD_FILE: бот пишет в JSONL-файл
+входящие обновления Telegram, ответы AccuWeather и моменты запуска фоновых циклов
+(токен и ключ API вырезаются). Этот скрипт прогоняет такую запись через Dispatcher
+и циклы мониторинга быстрее реального времени, подменяя AccuWeather и Telegram
+заглушками, и печатает задержки обработки и количество обращений к API.
+
+Пример:
+    python replay.py traffic.jsonl --speed 0 --api-latency 0.05
+"""
+import argparse
+import asyncio
+import json
+import os
+import tempfile
+import time
+from collections import Counter, defaultdict, deque
+
+# Фиктивные секреты: ключ совпадает с маркером из записи, поэтому URL запросов
+# совпадают с записанными без дополнительной обработки
+REPLAY_BOT_TOKEN = "123456:replay"
+REPLAY_API_KEY = "<redacted>"
+
+# Методы Telegram, которые возвращают объект сообщения
+MESSAGE_METHODS = {"sendMessage", "editMessageText", "sendLocation", "sendPhoto"}
+
+
+def load_bot_module(subscriptions=None):
+    """
+    Импортирует бота с фиктивными секретами и изолированным файлом подписок
+    """
+    os.environ["BOT_TOKEN"] = REPLAY_BOT_TOKEN
+    os.environ["ACCUWEATHER_API_KEY"] = REPLAY_API_KEY
+    os.environ.pop("TRAFFIC_RECORD_FILE", None)
+    # Запись содержит ответы только основного поставщика: запасной при воспроизведении не нужен
+    os.environ["WEATHER_SECONDARY_PROVIDER"] = ""
+    # Время между событиями сжимается, поэтому ограничение частоты запросов отключаем
+    os.environ["THROTTLE_ENABLED"] = "0"
+    os.environ.setdefault("STATE_SNAPSHOT_FILE", os.path.join(tempfile.mkdtemp(), "state_snapshot.bin"))
+
+    import proverka
+
+    # Подписки не должны попасть в настоящий subscriptions.json
+    proverka.SUBSCRIPTIONS_FILE = os.path.join(tempfile.mkdtemp(), "subscriptions.json")
+    proverka.user_subscriptions.clear()
+    if subscriptions:
+        proverka.user_subscriptions.update(subscriptions)
+    return proverka
+
+
+def endpoint_name(url):
+    """
+    Определяет тип запроса к поставщику погоды по URL
+    """
+    for marker, name in (
+        ("geocoding-api.open-meteo.com", "openmeteo_search"),
+        ("api.open-meteo.com", "openmeteo_forecast"),
+        ("cities/geoposition", "geoposition"),
+        ("cities/search", "location_search"),
+        ("currentconditions", "current"),
+        ("forecasts/v1/hourly", "hourly"),
+        ("forecasts/v1/daily", "daily"),
+    ):
+        if marker in url:
+            return name
+    return "other"
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(p / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+class StubResponse:
+    def __init__(self, status, data, latency=0.0):
+        self.status = status
+        self._data = data
+        self._latency = latency
+
+    async def json(self, **kwargs):
+        return self._data
+
+    async def __aenter__(self):
+        if self._latency:
+            await asyncio.sleep(self._latency)
+        return self
+
+    async def __aexit__(self, *exc_info):
+        return False
+
+
+class StubSession:
+    """
+    Заглушка aiohttp-сессии: отдает записанные ответы по URL в порядке записи,
+    а когда они заканчиваются — повторяет последний
+    """
+
+    def __init__(self, responses=None, latency=0.0, fallback=None):
+        self.responses = responses or {}  # {url: deque([(status, data), ...])}
+        self.latency = latency
+        self.fallback = fallback  # функция url -> (status, data) для незаписанных запросов
+        self.calls = Counter()
+
+    def add(self, url, status, data):
+        self.responses.setdefault(url, deque()).append((status, data))
+
+    def get(self, url, **kwargs):
+        self.calls[endpoint_name(url)] += 1
+        queue = self.responses.get(url)
+        if queue:
+            status, data = queue.popleft() if len(queue) > 1 else queue[0]
+        elif self.fallback:
+            status, data = self.fallback(url)
+        else:
+            status, data = 404, None
+        return StubResponse(status, data, self.latency)
+
+    async def close(self):
+        pass
+
+
+class StubTelegram:
+    """
+    Заглушка Bot API: считает вызовы методов и возвращает минимальные ответы
+    """
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.calls = Counter()
+        self.messages_by_chat = Counter()
+        self._message_id = 0
+
+    def install(self, bot):
+        # Подменяем только отправку: полосы Telegram в боте продолжают работать
+        bot.send_request = self.request
+
+    async def request(self, method, data=None, files=None, **kwargs):
+        self.calls[method] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        data = data or {}
+        if method == "getMe":
+            return {"id": 123456, "is_bot": True, "first_name": "Nami", "username": "nami_bot"}
+        if method in MESSAGE_METHODS:
+            self._message_id += 1
+            chat_id = int(data.get("chat_id") or 0)
+            self.messages_by_chat[chat_id] += 1
+            return {
+                "message_id": int(data.get("message_id") or self._message_id),
+                "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "private"},
+                "text": data.get("text", ""),
+            }
+        return True
+
+
+def update_user_id(raw_update):
+    """
+    Находит пользователя, от которого пришло обновление
+    """
+    for value in raw_update.values():
+        if isinstance(value, dict) and "from" in value:
+            return value["from"]["id"]
+    return None
+
+
+def load_trace(path):
+    with open(path, "r", encoding="utf-8") as f:
+        entries = [json.loads(line) for line in f if line.strip()]
+    entries.sort(key=lambda entry: entry["t"])
+    return entries
+
+
+async def replay(entries, bot_module, speed=0.0, api_latency=0.0, telegram_latency=0.0):
+    """
+    Воспроизводит записанные события и возвращает отчет
+    """
+    from aiogram import Bot, Dispatcher, types
+
+    session = StubSession(latency=api_latency)
+    for entry in entries:
+        if entry["kind"] == "api":
+            session.add(entry["url"], entry["status"], entry["data"])
+    telegram = StubTelegram(latency=telegram_latency)
+
+    bot_module.session = session
+    telegram.install(bot_module.bot)
+    Bot.set_current(bot_module.bot)
+    Dispatcher.set_current(bot_module.dp)
+
+    cycles = {"weather_monitor": bot_module.run_monitor_cycle, "daily_forecast": bot_module.broadcast_daily_forecast}
+    latencies = defaultdict(list)  # {тип события: [задержка, ...]}
+    errors = Counter()
+
+    async def timed(kind, coro, previous=None):
+        # Обновления одного пользователя обрабатываются по порядку, как при polling
+        if previous:
+            await asyncio.wait([previous])
+        started = time.perf_counter()
+        try:
+            await coro
+        except Exception as e:
+            errors[f"{kind}: {type(e).__name__}"] += 1
+        latencies[kind].append(time.perf_counter() - started)
+
+    tasks = []
+    user_tails = {}  # {user_id: последняя задача обработки обновлений пользователя}
+    started = time.perf_counter()
+    first_t = entries[0]["t"] if entries else 0.0
+    for entry in entries:
+        if speed > 0:
+            delay = (entry["t"] - first_t) / speed - (time.perf_counter() - started)
+            if delay > 0:
+                await asyncio.sleep(delay)
+
+        if entry["kind"] == "update":
+            user_id = update_user_id(entry["update"])
+            update = types.Update(**entry["update"])
+            task = asyncio.create_task(
+                timed("update", bot_module.dp.updates_handler.notify(update), user_tails.get(user_id))
+            )
+            user_tails[user_id] = task
+            tasks.append(task)
+        elif entry["kind"] == "cycle" and entry.get("loop") in cycles:
+            tasks.append(asyncio.create_task(timed(entry["loop"], cycles[entry["loop"]]())))
+
+    await asyncio.gather(*tasks)
+
+    return {
+        "recorded_seconds": (entries[-1]["t"] - first_t) if entries else 0.0,
+        "replay_seconds": time.perf_counter() - started,
+        "latencies": dict(latencies),
+        "api_calls": dict(session.calls),
+        "telegram_calls": dict(telegram.calls),
+        "errors": dict(errors),
+    }
+
+
+def print_report(report):
+    print(f"Длительность записи: {report['recorded_seconds']:.1f} с, воспроизведение: {report['replay_seconds']:.2f} с")
+    for kind, values in sorted(report["latencies"].items()):
+        print(
+            f"{kind}: {len(values)} шт., задержка p50 {percentile(values, 50) * 1000:.1f} мс, "
+            f"p95 {percentile(values, 95) * 1000:.1f} мс, p99 {percentile(values, 99) * 1000:.1f} мс, "
+            f"max {max(values) * 1000:.1f} мс"
+        )
+    print(f"Запросы к AccuWeather: {sum(report['api_calls'].values())}")
+    for endpoint, count in sorted(report["api_calls"].items()):
+        print(f"  {endpoint}: {count}")
+    print(f"Вызовы Telegram: {sum(report['telegram_calls'].values())}")
+    for method, count in sorted(report["telegram_calls"].items()):
+        print(f"  {method}: {count}")
+    for error, count in sorted(report["errors"].items()):
+        print(f"Ошибка {error}: {count}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Воспроизведение записанного трафика бота")
+    parser.add_argument("trace", help="JSONL-файл, записанный через TRAFFIC_RECORD_FILE")
+    parser.add_argument("--speed", type=float, default=0.0,
+                        help="ускорение относительно записи (0 — без пауз между событиями)")
+    parser.add_argument("--api-latency", type=float, default=0.0, help="задержка ответа AccuWeather, с")
+    parser.add_argument("--telegram-latency", type=float, default=0.0, help="задержка ответа Telegram, с")
+    parser.add_argument("--subscriptions", help="файл подписок для фоновых циклов (копия subscriptions.json)")
+    args = parser.parse_args()
+
+    subscriptions = None
+    if args.subscriptions:
+        with open(args.subscriptions, "r", encoding="utf-8") as f:
+            subscriptions = json.load(f)
+
+    bot_module = load_bot_module(subscriptions)
+    report = asyncio.run(
+        replay(load_trace(args.trace), bot_module, args.speed, args.api_latency, args.telegram_latency)
+    )
+    print_report(report)
+
+
+if __name__ == "__main__":
+    main()
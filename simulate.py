@@ -0,0 +1,139 @@
+"""
+Симуляция фоновых циклов бота в виртуальном времени.
+
+Цикл событий VirtualTimeLoop не спит: когда ждать нечего, кроме таймеров, он сразу
+переводит свои часы к ближайшему таймеру. Бот получает часы этого цикла (proverka.clock),
+поставщика погоды из weather_fakes.py и заглушку Telegram из replay.py, поэтому недели
+мониторинга и утренних рассылок для тысяч подписчиков проходят за секунды.
+По каждому симулированному дню печатаются запросы к поставщику, отправленные
+сообщения и прирост памяти (tracemalloc).
+
+Пример:
+    python simulate.py --days 14 --users 5000 --cities 300 --no-memory
+"""
+import argparse
+import asyncio
+import logging
+import random
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+
+from replay import StubTelegram
+from weather_fakes import FakeProvider, bot_module
+
+
+class VirtualTimeLoop(asyncio.SelectorEventLoop):
+    """
+    Цикл событий с виртуальным временем: ожидание таймера в select()
+    заменяется мгновенным переводом часов
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.virtual_time = 0.0
+        select = self._selector.select
+
+        def virtual_select(timeout=None):
+            events = select(0)
+            if events:
+                return events
+            if timeout is None:
+                # Таймеров нет: ждем по-настоящему (например, результата из пула потоков)
+                return select(None)
+            self.virtual_time += timeout
+            return events
+
+        self._selector.select = virtual_select
+
+    def time(self):
+        return self.virtual_time
+
+
+class VirtualClock(bot_module.Clock):
+    def __init__(self, loop, start):
+        self.loop = loop
+        self.start = start
+
+    def now(self):
+        return self.start + timedelta(seconds=self.loop.time())
+
+    def time(self):
+        return self.start.timestamp() + self.loop.time()
+
+
+def synthetic_subscriptions(users, cities, seed=0):
+    generator = random.Random(seed)
+    return {
+        str(user_id): generator.sample([f"city{index}" for index in range(cities)], generator.randint(1, 3))
+        for user_id in range(users)
+    }
+
+
+async def simulate(args):
+    loop = asyncio.get_running_loop()
+    bot_module.clock = VirtualClock(loop, datetime.strptime(args.start, "%Y-%m-%d %H:%M"))
+    bot_module.user_subscriptions.update(synthetic_subscriptions(args.users, args.cities))
+    bot_module.subscriptions_state["loaded"] = True
+
+    provider = FakeProvider("fake", latency=args.api_latency)
+    bot_module.weather_router = bot_module.WeatherRouter(provider)
+    telegram = StubTelegram(latency=args.telegram_latency)
+    telegram.install(bot_module.bot)
+
+    if args.memory:
+        tracemalloc.start()
+    await bot_module.warm_start()
+
+    print(f"{args.users} подписчиков, {args.cities} городов, старт {bot_module.clock.now():%d.%m.%Y %H:%M}")
+    memory = tracemalloc.get_traced_memory()[0]
+    api_calls = sum(provider.calls.values())
+    messages = telegram.calls["sendMessage"]
+    started = time.perf_counter()
+    for day in range(1, args.days + 1):
+        day_started = time.perf_counter()
+        await asyncio.sleep(24 * 3600)
+        day_api_calls = sum(provider.calls.values()) - api_calls
+        day_messages = telegram.calls["sendMessage"] - messages
+        day_memory = tracemalloc.get_traced_memory()[0]
+        print(
+            f"день {day:>3} ({bot_module.clock.now():%d.%m}): запросов к поставщику {day_api_calls}, "
+            f"сообщений {day_messages}, память {day_memory / 2 ** 20:.1f} МБ "
+            f"({(day_memory - memory) / 2 ** 10:+.0f} КБ), {time.perf_counter() - day_started:.1f} с"
+        )
+        api_calls += day_api_calls
+        messages += day_messages
+        memory = day_memory
+
+    print(f"Запросы по видам: {dict(provider.calls)}")
+    print(f"Симуляция {args.days} дн. заняла {time.perf_counter() - started:.1f} с")
+
+    # Останавливаем фоновые циклы бота
+    tasks = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Симуляция фоновых циклов бота в виртуальном времени")
+    parser.add_argument("--days", type=int, default=7)
+    parser.add_argument("--users", type=int, default=2000)
+    parser.add_argument("--cities", type=int, default=200)
+    parser.add_argument("--start", default="2026-01-05 00:00", help="виртуальное время старта, ГГГГ-ММ-ДД ЧЧ:ММ")
+    parser.add_argument("--api-latency", type=float, default=0.3, help="задержка поставщика погоды, виртуальные с")
+    parser.add_argument("--telegram-latency", type=float, default=0.05, help="задержка Telegram, виртуальные с")
+    parser.add_argument("--no-memory", dest="memory", action="store_false",
+                        help="не измерять память (tracemalloc замедляет симуляцию в 2-3 раза)")
+    args = parser.parse_args()
+
+    logging.disable(logging.WARNING)
+    loop = VirtualTimeLoop()
+    try:
+        loop.run_until_complete(simulate(args))
+    finally:
+        loop.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,133 @@
+"""
+Замер холодного старта бота: время до первого ответа и до завершения прогрева.
+
+Каждый запуск выполняется в отдельном процессе, чтобы учитывать импорт модулей.
+Сравниваются обычный старт (FAST_START=0) и быстрый (FAST_START=1); Telegram и
+AccuWeather подменяются заглушками из replay.py.
+
+Пример:
+    python startup_bench.py --users 20000 --runs 5
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+METRICS = ("import", "on_startup", "first_reply", "warm_start")
+
+
+def write_synthetic_state(bot_module, users):
+    """
+    Создает файл подписок и снимок состояния заданного размера
+    """
+    subscriptions = {str(user_id): [f"city{user_id % 500}", f"city{user_id % 37}"] for user_id in range(users)}
+    with open(bot_module.SUBSCRIPTIONS_FILE, "w", encoding="utf-8") as f:
+        json.dump(subscriptions, f)
+
+    for city_index in range(500):
+        bot_module.city_location_keys[f"city{city_index}"] = str(100000 + city_index)
+    bot_module.save_state_snapshot()
+    bot_module.city_location_keys.clear()
+
+
+async def measure_startup(bot_module, spawned_at):
+    from aiogram import Bot, Dispatcher, types
+    from replay import StubSession, StubTelegram
+
+    telegram = StubTelegram()
+    first_reply = asyncio.get_running_loop().create_future()
+    stub_request = telegram.request
+
+    async def request(method, data=None, files=None, **kwargs):
+        result = await stub_request(method, data, files, **kwargs)
+        if method == "sendMessage" and not first_reply.done():
+            first_reply.set_result(time.time())
+        return result
+
+    bot_module.bot.send_request = request
+    bot_module.aiohttp.ClientSession = lambda: StubSession()
+    Bot.set_current(bot_module.bot)
+    Dispatcher.set_current(bot_module.dp)
+
+    await bot_module.on_startup(bot_module.dp)
+    started_at = time.time()
+
+    update = types.Update(**{
+        "update_id": 1,
+        "message": {
+            "message_id": 1, "date": int(time.time()), "text": "/start",
+            "chat": {"id": 1, "type": "private"},
+            "from": {"id": 1, "is_bot": False, "first_name": "bench"},
+            "entities": [{"type": "bot_command", "offset": 0, "length": 6}],
+        },
+    })
+    await bot_module.dp.updates_handler.notify(update)
+    replied_at = await first_reply
+    await bot_module.warm_start_done.wait()
+    warm_at = time.time()
+
+    return {
+        "on_startup": started_at - spawned_at,
+        "first_reply": replied_at - spawned_at,
+        "warm_start": warm_at - spawned_at,
+    }
+
+
+def run_child(spawned_at, users):
+    logging.disable(logging.WARNING)
+    os.environ["BACKGROUND_START_DELAY"] = "0"
+
+    from replay import load_bot_module
+
+    bot_module = load_bot_module()
+    imported_at = time.time()
+    write_synthetic_state(bot_module, users)
+
+    # Подготовка синтетического состояния не засчитывается во время старта
+    setup_seconds = time.time() - imported_at
+    metrics = asyncio.run(measure_startup(bot_module, spawned_at + setup_seconds))
+    metrics["import"] = imported_at - spawned_at
+    print(json.dumps(metrics))
+
+
+def run_parent(users, runs):
+    for fast_start in ("0", "1"):
+        samples = {metric: [] for metric in METRICS}
+        for _ in range(runs):
+            env = dict(os.environ, FAST_START=fast_start)
+            spawned_at = time.time()
+            output = subprocess.run(
+                [sys.executable, __file__, "--child", str(spawned_at), "--users", str(users)],
+                env=env, capture_output=True, text=True, check=True,
+            ).stdout
+            metrics = json.loads(output.strip().splitlines()[-1])
+            for metric in METRICS:
+                samples[metric].append(metrics[metric])
+
+        mode = "быстрый старт" if fast_start == "1" else "обычный старт"
+        print(
+            f"{mode}: "
+            + ", ".join(f"{metric} {statistics.median(values) * 1000:.0f} мс" for metric, values in samples.items())
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Замер холодного старта бота")
+    parser.add_argument("--users", type=int, default=20000, help="количество подписчиков в синтетическом состоянии")
+    parser.add_argument("--runs", type=int, default=3, help="количество запусков на режим")
+    parser.add_argument("--child", type=float, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child is not None:
+        run_child(args.child, args.users)
+    else:
+        run_parent(args.users, args.runs)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,189 @@
+"""
+Локальные поставщики погоды для проверки без сети.
+
+FakeProvider реализует интерфейс WeatherProvider из proverka.py и отдает
+детерминированные данные в общем виде с настраиваемой задержкой, долей медленных
+ответов и ошибок. Его можно подставить в бота вместо настоящих поставщиков:
+
+    from weather_fakes import FakeProvider, bot_module
+    bot_module.weather_router = bot_module.WeatherRouter(FakeProvider("primary"), FakeProvider("secondary"))
+
+Импорт модуля загружает бота с фиктивными секретами (см. replay.load_bot_module).
+Запуск как скрипта проверяет, что форматирование принимает данные поставщиков,
+и сравнивает задержки запросов с подстраховкой и без.
+
+Пример:
+    python weather_fakes.py --requests 2000 --slow-share 0.03 --slow-latency 2
+"""
+import argparse
+import asyncio
+import hashlib
+import math
+import random
+import time
+from collections import Counter
+from datetime import timedelta
+
+from replay import load_bot_module, percentile
+
+bot_module = load_bot_module()
+
+# Погода, которую по очереди «показывают» фальшивые поставщики
+FAKE_DESCRIPTIONS = ("Ясно", "Облачно", "Дождь", "Облачно", "Снег", "Туман")
+
+
+def location_seed(value):
+    return int(hashlib.md5(str(value).encode("utf-8")).hexdigest()[:8], 16)
+
+
+class FakeProvider(bot_module.WeatherProvider):
+    """
+    Поставщик с синтетической погодой: значения зависят только от локации и часа
+    """
+
+    def __init__(self, name, latency=0.0, slow_share=0.0, slow_latency=0.0, fail_share=0.0, seed=0):
+        super().__init__()
+        self.name = name
+        self.latency = latency
+        self.slow_share = slow_share
+        self.slow_latency = slow_latency
+        self.fail_share = fail_share
+        self.random = random.Random(seed)
+        self.calls = Counter()
+
+    async def respond(self, method, result):
+        self.calls[method] += 1
+        delay = self.slow_latency if self.random.random() < self.slow_share else self.latency
+        if delay:
+            await asyncio.sleep(delay)
+        if self.random.random() < self.fail_share:
+            raise ConnectionError(f"{self.name}: искусственная ошибка")
+        return result
+
+    def hour(self, location, dt):
+        seed = location_seed(location)
+        hours = int(dt.timestamp() // 3600)
+        return {
+            "time": dt,
+            "temp": round(10 + seed % 15 + 6 * math.sin(hours * math.pi / 12), 1),
+            "desc": FAKE_DESCRIPTIONS[(seed + hours // 4) % len(FAKE_DESCRIPTIONS)],
+            "wind_speed": round(3 + (seed + hours) % 20, 1),
+            "precip_prob": (seed + hours * 7) % 101,
+            "is_day": 7 <= dt.hour < 20,
+        }
+
+    async def search(self, city):
+        return await self.respond("search", location_seed(city))
+
+    async def geoposition(self, lat, lon):
+        return await self.respond("geoposition", (location_seed(f"{lat:.2f},{lon:.2f}"), f"точке {lat:.2f}, {lon:.2f}"))
+
+    async def current(self, location):
+        now = bot_module.clock.now().replace(second=0, microsecond=0)
+        current = self.hour(location, now)
+        del current["precip_prob"]
+        return await self.respond("current", current)
+
+    async def hourly(self, location):
+        next_hour = bot_module.clock.now().replace(minute=0, second=0, microsecond=0) + timedelta(hours=1)
+        return await self.respond("hourly", [self.hour(location, next_hour + timedelta(hours=i)) for i in range(12)])
+
+    async def daily(self, location):
+        midnight = bot_module.clock.now().replace(hour=0, minute=0, second=0, microsecond=0)
+        hours = [self.hour(location, midnight + timedelta(hours=i)) for i in range(24)]
+        parts = {}
+        for is_day, part in ((True, "day"), (False, "night")):
+            part_hours = [hour for hour in hours if hour["is_day"] == is_day]
+            parts[part] = {
+                "desc": part_hours[len(part_hours) // 2]["desc"],
+                "wind_speed": max(hour["wind_speed"] for hour in part_hours),
+                "precip_prob": max(hour["precip_prob"] for hour in part_hours),
+            }
+        return await self.respond("daily", {
+            "date": midnight,
+            "min_temp": min(hour["temp"] for hour in hours),
+            "max_temp": max(hour["temp"] for hour in hours),
+            **parts,
+        })
+
+
+async def check_formatters(provider):
+    """
+    Прогоняет данные поставщика через все форматтеры бота
+    """
+    formatters = {
+        "current": bot_module.format_current_weather,
+        "hourly": bot_module.format_hourly_forecast,
+        "daily": bot_module.format_daily_forecast,
+    }
+    for kind, formatter in formatters.items():
+        formatter("город", await provider.fetch(kind, "город"))
+    _, found = await provider.fetch_many(tuple(formatters), "город")
+    for kind, formatter in formatters.items():
+        formatter("город", found[kind])
+
+    series = bot_module.CitySeries()
+    series.add_revision(await provider.fetch("hourly", "город"), time.time())
+    bot_module.format_trend("город", series)
+    await provider.fetch_at("current", 41.3, 69.28)
+
+
+async def measure(router, requests, concurrency):
+    """
+    Выполняет запросы текущей погоды через router и возвращает (задержки, количество неудач)
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+
+    async def one(index):
+        async with semaphore:
+            started = time.perf_counter()
+            result = await router.request("fetch", "current", f"city{index % 100}")
+            latencies.append(time.perf_counter() - started)
+            return result is not None
+
+    results = await asyncio.gather(*(one(index) for index in range(requests)))
+    return latencies, results.count(False)
+
+
+async def run(args):
+    await check_formatters(FakeProvider("check"))
+    print("Форматирование данных поставщика: OK")
+
+    def primary():
+        return FakeProvider(
+            "primary", args.latency, args.slow_share, args.slow_latency, args.fail_share, seed=1
+        )
+
+    secondaries = (("без подстраховки", None), ("с подстраховкой", FakeProvider("secondary", args.secondary_latency, seed=2)))
+    for title, secondary in secondaries:
+        router = bot_module.WeatherRouter(primary(), secondary)
+        latencies, failures = await measure(router, args.requests, args.concurrency)
+        print(
+            f"{title}: p50 {percentile(latencies, 50) * 1000:.0f} мс, p95 {percentile(latencies, 95) * 1000:.0f} мс, "
+            f"p99 {percentile(latencies, 99) * 1000:.0f} мс, max {max(latencies) * 1000:.0f} мс, неудач {failures}"
+        )
+        if secondary:
+            print(
+                f"  подстраховано {router.stats['hedged']} из {router.stats['requests']}, "
+                f"запасной ответил первым {router.stats['secondary_wins']} раз, "
+                f"порог {router.hedge_delay('fetch') * 1000:.0f} мс"
+            )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Проверка поставщиков погоды и подстраховки без сети")
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=10)
+    parser.add_argument("--latency", type=float, default=0.05, help="обычная задержка основного поставщика, с")
+    parser.add_argument("--slow-share", type=float, default=0.03, help="доля медленных ответов основного поставщика")
+    parser.add_argument("--slow-latency", type=float, default=2.0, help="задержка медленных ответов, с")
+    parser.add_argument("--fail-share", type=float, default=0.01, help="доля ошибок основного поставщика")
+    parser.add_argument("--secondary-latency", type=float, default=0.1, help="задержка запасного поставщика, с")
+    args = parser.parse_args()
+
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()